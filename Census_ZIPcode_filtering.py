@@ -3,6 +3,8 @@ import pandas as pd
 import geopandas as gpd
 from pathlib import Path
 
+from geometry_cache import read_layer
+
 # ======= EDIT THESE =======
 COUNTIES_SHP = r"data/tl_2023_us_county/tl_2023_us_county.shp"  # Tiger shapefile county
 ZCTA_SHP     = r"data/tl_2023_us_zcta520/tl_2023_us_zcta520.shp" # Tiger shapefile ZIP
@@ -13,17 +15,25 @@ OUTPUT_DATA  = "acs_santa_clara_only.csv"     # .csv or .parquet
 STATEFP_CA = "06"
 COUNTYFP_SANTA_CLARA = "085"  # 06085, can be changed for desired county
 
-def load_sc_polygon(counties_path: str) -> gpd.GeoDataFrame:
-    gdf = gpd.read_file(counties_path)
+def load_counties(counties_path: str, statefp: str = STATEFP_CA) -> gpd.GeoDataFrame:
+    # All counties of the state, with a 5 digit GEOID (state + county FIPS) used to select them
+    gdf = read_layer(counties_path, "counties") # reprojected once, then memory-mapped from data/geometry_cache
     state_col = "STATEFP" if "STATEFP" in gdf.columns else "STATEFP20"
     county_col = "COUNTYFP" if "COUNTYFP" in gdf.columns else "COUNTYFP20"
-    sc = gdf[(gdf[state_col] == STATEFP_CA) & (gdf[county_col] == COUNTYFP_SANTA_CLARA)]
+    gdf = gdf[gdf[state_col] == statefp].copy()
+    gdf["GEOID"] = gdf[state_col] + gdf[county_col]
+    return gdf.to_crs(epsg=4326)
+
+def load_sc_polygon(counties_path: str, county_geoid: str = STATEFP_CA + COUNTYFP_SANTA_CLARA) -> gpd.GeoDataFrame:
+    counties = load_counties(counties_path, county_geoid[:2])
+    sc = counties[counties["GEOID"] == county_geoid]
     if sc.empty:
-        raise ValueError("Santa Clara County not found in the counties shapefile.")
-    return sc.dissolve().to_crs(epsg=4326)
+        raise ValueError(f"County {county_geoid} not found in the counties shapefile.")
+    return sc.dissolve()
 
-def load_zctas(zcta_path: str) -> gpd.GeoDataFrame:
-    z = gpd.read_file(zcta_path)
+def load_zctas(zcta_path: str, bbox=None) -> gpd.GeoDataFrame:
+    # bbox (minx, miny, maxx, maxy) only reads the ZCTAs intersecting it instead of the whole country
+    z = read_layer(zcta_path, "zctas", bbox=bbox)
     if "ZCTA5CE20" in z.columns: z = z.rename(columns={"ZCTA5CE20": "ZCTA5"})
     elif "ZCTA5CE10" in z.columns: z = z.rename(columns={"ZCTA5CE10": "ZCTA5"})
     elif "GEOID10"   in z.columns: z = z.rename(columns={"GEOID10": "ZCTA5"})
@@ -53,26 +63,31 @@ def extract_zcta_from_geo_id(df: pd.DataFrame) -> pd.DataFrame:
 
     raise ValueError("Couldn't find ZCTA info. Expected GEO_ID or a ZIP/ZCTA column.")
 
+def zctas_in_county(zctas: gpd.GeoDataFrame, county_poly: gpd.GeoDataFrame) -> list:
+    join = zctas.sjoin(county_poly[["geometry"]], predicate="intersects", how="inner")
+    return sorted(join["ZCTA5"].unique().tolist())
+
+def read_acs(input_path: str) -> pd.DataFrame:
+    in_ext = Path(input_path).suffix.lower()
+    if in_ext == ".csv":
+        df = pd.read_csv(input_path, dtype=str)
+    elif in_ext in {".parquet", ".pq"}:
+        df = pd.read_parquet(input_path)
+    else:
+        raise ValueError("INPUT_DATA must be .csv or .parquet")
+    return extract_zcta_from_geo_id(df)
+
 def main():
     # 1) Geographies
     sc_poly = load_sc_polygon(COUNTIES_SHP)
-    zctas = load_zctas(ZCTA_SHP)
+    zctas = load_zctas(ZCTA_SHP, bbox=tuple(sc_poly.total_bounds))
 
     # 2) ZCTAs that intersect Santa Clara County
-    sc_join = zctas.sjoin(sc_poly[["geometry"]], predicate="intersects", how="inner")
-    sc_zips = sorted(sc_join["ZCTA5"].unique().tolist())
+    sc_zips = zctas_in_county(zctas, sc_poly)
     print(f"Found {len(sc_zips)} ZCTAs intersecting Santa Clara County.")
 
     # 3) ACS data
-    in_ext = Path(INPUT_DATA).suffix.lower()
-    if in_ext == ".csv":
-        df = pd.read_csv(INPUT_DATA, dtype=str)
-    elif in_ext in {".parquet", ".pq"}:
-        df = pd.read_parquet(INPUT_DATA)
-    else:
-        raise ValueError("INPUT_DATA must be .csv or .parquet")
-
-    df = extract_zcta_from_geo_id(df)
+    df = read_acs(INPUT_DATA)
     before = len(df)
     df = df[df["ZCTA5"].isin(sc_zips)].copy()
     after = len(df)
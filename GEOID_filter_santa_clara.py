@@ -1,15 +1,23 @@
 # The purpose of this file is to take the previously obtained csv file for all of California and filter it so that it only has the GEOIDs of the desired county 
-import pandas as pd
+# GEOIDtocoord.py already streams only the selected county by default, this filter matters when it was run for the whole state (prefix 06)
+import sys
 
-# Load GEOID-to-coordinates file
-df = pd.read_csv("data/GEOID_to_Centroid.csv", dtype={'w_geocode': str, 'h_geocode': str})
+from interchange import read_table, write_table, prefix_filter
 
-# Filter for GEOIDs that start with '6085' (Santa Clara County) 
-# Can be changed if another county is to be analyzed
-sb_df = df[df['w_geocode'].str.startswith('06085')]
-sb_df = sb_df[sb_df['h_geocode'].str.startswith('06085')]
+EXPORT_CSV = '--csv' in sys.argv[1:] # also write the output as CSV next to the Parquet file
 
-sb_df.to_csv("data/santa_clara_geoids.csv", index=False)
+# Filter for GEOIDs that start with '06085' (Santa Clara County)
+# Can be changed if another county is to be analyzed, by passing its GEOID (python GEOID_filter_santa_clara.py 06001)
+args = [a for a in sys.argv[1:] if not a.startswith("--")]
+COUNTY = args[0] if args else '06085'
+
+# Load GEOID-to-coordinates file, the county filter on both GEOIDs is pushed down to the Parquet reader
+sb_df = read_table(
+    "data/GEOID_to_Centroid.parquet",
+    filters=prefix_filter('w_geocode', COUNTY) + prefix_filter('h_geocode', COUNTY)
+)
+
+write_table(sb_df, "data/santa_clara_geoids.parquet", export_csv=EXPORT_CSV)
 
 #Optionally give the total number of filtered rows for the chosen County
 print(f"Filtered {len(sb_df)} rows for selected County.")
\ No newline at end of file
@@ -1,69 +1,127 @@
-#The purpose of this code is to read the LODES data as well as tiger shapefiles and create a file that relates all California GEOIDs (15 digit) to the coordinates of their centroids
-import geopandas as gpd
-import pandas as pd
-
-# The blocks variable will read the tiger shapefile for the state of California, of any other desired location
-blocks = gpd.read_file("data/tl_2023_06_tabblock20/tl_2023_06_tabblock20.shp")
-
-# Then, a collumn containing a 15 digit GEOID will be generated to allow for later crossing between the LODES and tiger shapefiles
-blocks['GEOID'] = (
-    blocks['STATEFP20'] +
-    blocks['COUNTYFP20'] +
-    blocks['TRACTCE20'] +
-    blocks['BLOCKCE20']
-)
-
-# Keep only GEOID and geometry collumns of the dataset 
-blocks = blocks[['GEOID', 'geometry']]
-blocks = blocks.to_crs(epsg=4326) # change the geometry collumn to standard coordinate reference system 4326
-# debugging print statement, ignore if not necessary 
-
-#print(blocks.crs)
-
-# create a new collumn to blocks that has the coordinates of the centroid of each GEOID and then drop the original geometry collumn
-blocks['centroid'] = blocks.geometry.centroid
-blocks = blocks.drop(columns='geometry')
-# debugging print statement, ignore if not necessary 
-
-
-#print(blocks)
+#The purpose of this code is to read the LODES data as well as tiger shapefiles and create a file that relates the GEOIDs (15 digit) of the selected area to the coordinates of their centroids
+#The LODES file is streamed in chunks and filtered to the selected GEOID prefix (a county such as 06085, or a whole state such as 06) while it is read,
+#and only the blocks of that area are read from the tiger shapefile, so memory is proportional to the selected area and not to the state.
+#
+#Usage:
+#   python GEOIDtocoord.py [geoid_prefix] [--csv]
+import sys
 
+import pandas as pd
 
-file_path = "data/LODES_data_cars.csv" #read LODES dataset for all commuters in california (edited to include number of cars)
-# Change geocode columns to strings in order to prevent errors
-# Note that this edited version of the LODES database has removed the zeroes from the front of the strings. If using a different data source, this may need to be addressed in this file and in the filtering file.
-dtype_spec = {
-    'w_geocode': str,
-    'h_geocode': str,
-    'Number of Cars': float
-}
-
-
-# assign LODES data to a dataframe 
-LODES_df = pd.read_csv(file_path, usecols = ['w_geocode', 'h_geocode','Number of Cars'], dtype=dtype_spec)
-LODES_df['w_geocode'] = LODES_df['w_geocode'].str.zfill(15)
-LODES_df['h_geocode'] = LODES_df['h_geocode'].str.zfill(15)
-
-# Create collumns for both the x and y coordinates of the latitudes of each GEOID centroid 
-blocks['lat'] = blocks['centroid'].y
-blocks['lon'] = blocks['centroid'].x
-
-# merge both dataframes to add the latitude and longitude coordinates of each home GEOID
-LODES_df = LODES_df.merge(
-    blocks.rename(columns={'GEOID': 'h_geocode', 'lat': 'home_lat', 'lon': 'home_lon'}),
-    on='h_geocode',
-    how='left'
-)
-
-print(LODES_df.head())
-
-# merge both dataframes to add the latitude and longitude coordinates of each work GEOID
-LODES_df = LODES_df.merge(
-    blocks.rename(columns={'GEOID': 'w_geocode', 'lat': 'work_lat', 'lon': 'work_lon'}),
-    on='w_geocode',
-    how='left'
-)
-
-# cleans the final dataframe and converts it to a .csv file which will be used in other files 
-LODES_df = LODES_df.drop(columns=['centroid_x','centroid_y'])
-LODES_df.to_csv("data/GEOID_to_Centroid.csv", index=False)
+from Census_ZIPcode_filtering import ZCTA_SHP, load_zctas
+from zcta_index import ZCTAIndex
+from interchange import write_table, read_table, prefix_filter
+from geometry_cache import read_layer
+
+BLOCKS_SHP = "data/tl_2023_06_tabblock20/tl_2023_06_tabblock20.shp"
+LODES_PATH = "data/LODES_data_cars.csv" # LODES dataset for all commuters in california (edited to include number of cars), a .parquet version is read with row-group filtering
+LODES_CHUNKSIZE = 1_000_000 # LODES rows read at once
+COUNTY = "06085" # GEOID prefix of the selected area, can be changed if another county is to be analyzed
+
+
+def load_block_centroids(geoid_prefix=COUNTY, blocks_path=BLOCKS_SHP):
+    # The blocks variable will read the tiger shapefile for the state of California, of any other desired location
+    # Only the blocks of the selected state/county are read from the shapefile
+    where = f"STATEFP20 = '{geoid_prefix[:2]}'"
+    if len(geoid_prefix) >= 5:
+        where += f" AND COUNTYFP20 = '{geoid_prefix[2:5]}'"
+    blocks = read_layer(blocks_path, "blocks", where=where) # reprojected once, then memory-mapped from data/geometry_cache
+
+    # Then, a collumn containing a 15 digit GEOID will be generated to allow for later crossing between the LODES and tiger shapefiles
+    blocks['GEOID'] = (
+        blocks['STATEFP20'] +
+        blocks['COUNTYFP20'] +
+        blocks['TRACTCE20'] +
+        blocks['BLOCKCE20']
+    )
+    blocks = blocks[blocks['GEOID'].str.startswith(geoid_prefix)]
+
+    # Keep only GEOID and geometry collumns of the dataset
+    blocks = blocks[['GEOID', 'geometry']]
+    blocks = blocks.to_crs(epsg=4326) # change the geometry collumn to standard coordinate reference system 4326
+    # debugging print statement, ignore if not necessary
+
+    #print(blocks.crs)
+
+    # create a new collumn to blocks that has the coordinates of the centroid of each GEOID and then drop the original geometry collumn
+    centroids = blocks.geometry.centroid
+    blocks = pd.DataFrame({'GEOID': blocks['GEOID'].to_numpy(), 'lat': centroids.y.to_numpy(), 'lon': centroids.x.to_numpy()})
+    # debugging print statement, ignore if not necessary
+
+    #print(blocks)
+    return blocks
+
+
+def read_lodes(geoid_prefix=COUNTY, path=LODES_PATH, chunksize=LODES_CHUNKSIZE):
+    """LODES rows whose home and work GEOIDs both start with geoid_prefix, read chunk by chunk."""
+    columns = ['w_geocode', 'h_geocode', 'Number of Cars']
+    if path.endswith(".parquet"):
+        # Parquet row groups outside the prefix range are skipped by the reader
+        return read_table(path, columns=columns, filters=prefix_filter('w_geocode', geoid_prefix) + prefix_filter('h_geocode', geoid_prefix))
+
+    # Change geocode columns to strings in order to prevent errors
+    # Note that this edited version of the LODES database has removed the zeroes from the front of the strings. If using a different data source, this may need to be addressed in this file and in the filtering file.
+    dtype_spec = {
+        'w_geocode': str,
+        'h_geocode': str,
+        'Number of Cars': float
+    }
+    kept = []
+    for chunk in pd.read_csv(path, usecols=columns, dtype=dtype_spec, chunksize=chunksize):
+        chunk['w_geocode'] = chunk['w_geocode'].str.zfill(15)
+        chunk['h_geocode'] = chunk['h_geocode'].str.zfill(15)
+        kept.append(chunk[chunk['w_geocode'].str.startswith(geoid_prefix) & chunk['h_geocode'].str.startswith(geoid_prefix)])
+    return pd.concat(kept, ignore_index=True)
+
+
+def assign_zctas(blocks, zctas=None):
+    # Assign every block centroid to the ZCTA containing it, once and in bulk, so the routing scripts do not have to
+    # look up the origin and destination ZIP of every route. Only the ZCTAs around the blocks are read from the shapefile,
+    # unless already loaded ZCTAs are passed.
+    if zctas is None:
+        bbox = (blocks['lon'].min(), blocks['lat'].min(), blocks['lon'].max(), blocks['lat'].max())
+        zctas = load_zctas(ZCTA_SHP, bbox=bbox)
+    zcta_idx = ZCTAIndex(zctas[['ZCTA5', 'geometry']])
+    blocks = blocks.copy()
+    blocks['zcta'] = zcta_idx.lookup(blocks['lat'].to_numpy(), blocks['lon'].to_numpy())
+    print(f"{blocks['zcta'].isna().sum()} of {len(blocks)} block centroids fall outside every ZCTA")
+    return blocks
+
+
+def join_centroids(LODES_df, blocks):
+    # merge both dataframes to add the latitude and longitude coordinates of each home GEOID
+    LODES_df = LODES_df.merge(
+        blocks.rename(columns={'GEOID': 'h_geocode', 'lat': 'home_lat', 'lon': 'home_lon', 'zcta': 'h_zcta'}),
+        on='h_geocode',
+        how='left'
+    )
+
+    print(LODES_df.head())
+
+    # merge both dataframes to add the latitude and longitude coordinates of each work GEOID
+    LODES_df = LODES_df.merge(
+        blocks.rename(columns={'GEOID': 'w_geocode', 'lat': 'work_lat', 'lon': 'work_lon', 'zcta': 'w_zcta'}),
+        on='w_geocode',
+        how='left'
+    )
+    return LODES_df
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    geoid_prefix = args[0] if args else COUNTY
+    export_csv = '--csv' in sys.argv[1:] # also write the outputs as CSV next to the Parquet files
+
+    LODES_df = read_lodes(geoid_prefix)
+    print(f"{len(LODES_df)} LODES rows with home and work GEOIDs in {geoid_prefix}")
+    blocks = assign_zctas(load_block_centroids(geoid_prefix))
+
+    # Save the block to ZCTA crosswalk
+    write_table(blocks[['GEOID', 'zcta']].rename(columns={'zcta': 'ZCTA5'}), "data/GEOID_to_ZCTA.parquet", export_csv=export_csv)
+
+    # converts the final dataframe to a Parquet file (typed GEOIDs) which will be used in other files
+    write_table(join_centroids(LODES_df, blocks), "data/GEOID_to_Centroid.parquet", export_csv=export_csv)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,12 +9,19 @@
 import os
 import time
 import requests
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
-from geopy.distance import geodesic
+from scipy import sparse
 import polyline
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from route_cache import RouteCache, GOOGLE_PROFILE
+from segment_attribution import SegmentAttributor, StreamingAttribution
+from async_routing import route_stream
+from zcta_index import load_zcta_index
+from od_compaction import compact_od, report_compaction
+from vmt_tensor import build_vmt_tensor, save_vmt_tensor
+from emission_factors import FACTOR_COLS, join_emission_factors, report_missing_factors
+from emission_aggregator import EmissionAggregator
+from interchange import read_table
 
 # === Google Maps API Key ===
 GOOGLE_MAPS_API_KEY = "" # <-- paste your key
@@ -23,18 +30,17 @@ if not GOOGLE_MAPS_API_KEY or "PASTE-YOUR-KEY" in GOOGLE_MAPS_API_KEY:
 
 # === Load Required Data ===
 start_time = time.time()
-zcta = gpd.read_file(
-    r"C:\Users\marco\OneDrive\Documents\ESENG masters\ESENG 503 2\nationwide_TIGER\tl_2020_us_zcta520.shp"
-).to_crs(epsg=4326)
-
-# Use pandas for CSVs (not geopandas)
-od_df = pd.read_csv(
-    r"C:\Users\marco\OneDrive\Área de Trabalho\santa_clara_geoids.csv",
-    dtype={"h_geocode": str}
+# County ZIP code areas prepared once by zcta_index.py (instead of the nationwide TIGER ZCTA shapefile)
+zcta_index = load_zcta_index(
+    r"C:\Users\marco\OneDrive\Área de Trabalho\zcta_index_06085.parquet"
 )
-emissions_df = pd.read_csv(
-    r"C:\Users\marco\OneDrive\Área de Trabalho\avg_emissions_per_geoid_SantaClara.csv",
-    dtype={"Census Block Group Code": str}
+
+# Parquet tables with typed GEOIDs (the CSV exports are used if only those exist)
+od_df = read_table(
+    r"C:\Users\marco\OneDrive\Área de Trabalho\santa_clara_geoids.parquet"
+)
+emissions_df = read_table(
+    r"C:\Users\marco\OneDrive\Área de Trabalho\avg_emissions_per_geoid_SantaClara.parquet"
 )
 
 # Ensure coordinate columns are numeric (coerce bad rows to NaN, which will be skipped later)
@@ -43,13 +49,24 @@ for col in ["home_lat", "home_lon", "work_lat", "work_lon"]:
 
 print(f"Data loading time: {time.time() - start_time:.2f} seconds")
 
-POLLUTANT_COLS = ['PM25_per_mile', 'SOx_per_mile', 'NOX_per_mile', 'VOC_per_mile', 'NH3_per_mile', 'CO2_per_mile']
+# Join per-mile emission factors of the home block group once, rows without factors are reported and skipped
+od_df, missing_factors = join_emission_factors(od_df, emissions_df)
+report_missing_factors(missing_factors)
+
+# === Route cache ===
+# Shared with the OSRM script, routes are stored under their own profile so both backends can live in the same file
+route_cache = RouteCache(r"C:\Users\marco\OneDrive\Área de Trabalho\route_cache.sqlite")
+
+ATTRIBUTION_BATCH_SIZE = 5000 # number of routes attributed to ZIPs per spatial index query
+MAX_WORKERS = 2 # number of Google requests in flight, keep at 2
+DISTANCE_MODE = 'vincenty' # 'vincenty' matches geopy's geodesic, 'haversine' is faster and within 0.25% (see distance_kernel.py)
+ASSIGNMENT = 'midpoint' # 'midpoint' gives each segment to the ZIP of its midpoint, 'clip' splits it exactly at ZIP boundaries (see clip_benchmark.py)
 
 # === Google Routes API v2 helper ===
-def fetch_route_coords_google(origin, destination):
+def fetch_route_polyline_google(origin, destination):
     """
     origin/destination: (lat, lon)
-    Returns list[(lat, lon)] for the route geometry using Google Routes API v2.
+    Returns the encoded polyline of the route using Google Routes API v2.
     """
     gmaps_url = "https://routes.googleapis.com/directions/v2:computeRoutes"
     headers = {
@@ -92,11 +109,30 @@ def fetch_route_coords_google(origin, destination):
             last_err = RuntimeError("No encoded polyline in Google response.")
             continue
 
-        return polyline.decode(enc)
+        return enc
 
     raise last_err or RuntimeError("Google Directions failed after retries.")
 
-# === Emissions calculation per OD pair ===
+def fetch_route_coords_google(origin, destination):
+    """
+    origin/destination: (lat, lon)
+    Returns list[(lat, lon)] for the route geometry, only calling the Google API when the route is not cached.
+    """
+    enc = route_cache.get_or_fetch(GOOGLE_PROFILE, origin, destination, fetch_route_polyline_google)
+    return polyline.decode(enc)
+
+# === Compact OD pairs into unique routes ===
+# Rows without home/work ZIP are dropped before any paid routing call
+no_zip = od_df['h_zcta'].isna() | od_df['w_zcta'].isna()
+if no_zip.any():
+    print(f"[!] Origin/Dest ZIP not found for {no_zip.sum()} OD rows, skipped")
+od_df = od_df[~no_zip]
+
+# Rows sharing the same home/work centroids are routed once and fanned back out after routing
+routes_df, fanout_df = compact_od(od_df, attribution_cols=['block_group', 'h_zcta', 'w_zcta'])
+report_compaction(len(od_df), routes_df)
+
+# === Route geometry per unique OD pair ===
 def process_route(idx_row):
     idx, row = idx_row
 
@@ -107,125 +143,70 @@ def process_route(idx_row):
     origin = (row['home_lat'], row['home_lon'])
     destination = (row['work_lat'], row['work_lon'])
 
-    # Takes first 12 digits of h_geocode
-    origin_tract = str(row['h_geocode'])[:12]
-
-    # Filter emissions_df for a matching GEOID
-    emission_row = emissions_df[emissions_df['Census Block Group Code'] == origin_tract]
-    if emission_row.empty:
-        return {'route_idx': idx, 'error': f"No emissions data for GEOID {origin_tract}"}
-    emissions = emission_row.iloc[0]
-
     try:
         # === GOOGLE ROUTING CALL ===
         route_coords = fetch_route_coords_google(origin, destination)
 
-        # Build segment midpoints + distances
-        segments = []
-        for a, b in zip(route_coords[:-1], route_coords[1:]):
-            distance = geodesic(a, b).miles
-            midpoint_geom = Point((a[1] + b[1]) / 2, (a[0] + b[0]) / 2)
-            segments.append({'geometry': midpoint_geom, 'distance_miles': distance})
-
-        if not segments:
+        if len(route_coords) < 2:
             return {'route_idx': idx, 'error': "No route segments"}
 
-        seg_df = pd.DataFrame(segments)
-        seg_gdf = gpd.GeoDataFrame(seg_df, geometry='geometry', crs='EPSG:4326')
-
-        # More forgiving join (include boundary hits)
-        seg_gdf = gpd.sjoin(seg_gdf, zcta[['ZCTA5CE20', 'geometry']], how='left', predicate='intersects')
-        seg_gdf = seg_gdf.dropna(subset=['ZCTA5CE20'])
-
-        if seg_gdf.empty:
-            return {'route_idx': idx, 'error': "All segment points fell outside ZCTAs after join"}
-
-        # Aggregate total travel miles per ZIP
-        zip_dist = seg_gdf.groupby('ZCTA5CE20')['distance_miles'].sum().reset_index()
-
-        # Multiply distance by per-mile emission factors to get emissions on each ZIP
-        for pollutant in POLLUTANT_COLS:
-            zip_dist[f'{pollutant}_emissions'] = zip_dist['distance_miles'] * emissions[pollutant]
-
-        # Origin/Destination ZIPs
-        origin_point = Point(origin[1], origin[0])
-        dest_point = Point(destination[1], destination[0])
-        origin_hit = zcta[zcta.contains(origin_point)]
-        dest_hit = zcta[zcta.contains(dest_point)]
-        origin_zip = origin_hit.iloc[0]['ZCTA5CE20'] if not origin_hit.empty else None
-        dest_zip = dest_hit.iloc[0]['ZCTA5CE20'] if not dest_hit.empty else None
-        if origin_zip is None or dest_zip is None:
-            return {'route_idx': idx, 'error': "Origin/Dest ZIP not found"}
-
-        # Build list of per-ZIP emissions for the current route
-        emissions_by_zip = []
-        for _, row_zip in zip_dist.iterrows():
-            emissions_by_zip.append({
-                'zip': row_zip['ZCTA5CE20'],
-                'PM25': row_zip['PM25_per_mile_emissions'],
-                'SOx': row_zip['SOx_per_mile_emissions'],
-                'NOX': row_zip['NOX_per_mile_emissions'],
-                'VOC': row_zip['VOC_per_mile_emissions'],
-                'NH3': row_zip['NH3_per_mile_emissions'],
-                'CO2': row_zip['CO2_per_mile_emissions']
-            })
-
-        return {
-            'route_idx': idx,
-            'origin_zip': origin_zip,
-            'dest_zip': dest_zip,
-            'emissions_by_zip': emissions_by_zip
-        }
+        # Route geometry is returned as is, miles per ZIP are attributed in batches as routes arrive
+        return {'route_idx': idx, 'route_coords': route_coords}
 
     except Exception as e:
         return {'route_idx': idx, 'error': str(e)}
 
-# === Run parallel routing with ThreadPool ===
-results = []
-t_parallel = time.time()
-with ThreadPoolExecutor(max_workers=2) as executor:  # keep max_workers=2
-    futures = [executor.submit(process_route, item) for item in od_df.head(20).iterrows()]  # <- toggle subset here
-    #futures = [executor.submit(process_route, item) for item in od_df.iterrows()]            # <- full dataset
-    for future in as_completed(futures):
-        results.append(future.result())
+# === Streaming routing and segment-to-ZIP attribution ===
+# Unique routes are streamed to a bounded number of in-flight Google calls, and every decoded route is handed to the
+# streaming attribution as it arrives, so only the current batch of coordinates is kept in memory.
+# More forgiving join (include boundary hits), segment midpoints of many routes are assigned in one query per batch.
+# In 'clip' assignment the predicate is not used, a segment on the edge shared by two ZIPs is split between them.
+attributor = SegmentAttributor.from_index(zcta_index, predicate='intersects', distance_mode=DISTANCE_MODE, assignment=ASSIGNMENT)
+attribution = StreamingAttribution(attributor, batch_size=ATTRIBUTION_BATCH_SIZE)
+n_errors = 0
+
+def collect_route(r):
+    global n_errors
+    if 'error' in r:
+        n_errors += 1
+        print("ERROR:", r['error'])
+    else:
+        attribution.add(r['route_idx'], r['route_coords'])
 
-print(f"Total execution time: {time.time() - t_parallel:.2f} seconds")
+t_parallel = time.time()
+route_stream(routes_df.head(20).iterrows(), process_route, collect_route, max_in_flight=MAX_WORKERS)  # <- toggle subset here
+#route_stream(routes_df.iterrows(), process_route, collect_route, max_in_flight=MAX_WORKERS)          # <- full dataset
+routed_keys, route_miles = attribution.result()
+route_pos = pd.Series(np.arange(len(routed_keys)), index=routed_keys)
+
+print(f"Total execution time: {time.time() - t_parallel:.2f} seconds ({len(routed_keys)} routed, {n_errors} errors)")
+print(f"Route cache: {route_cache.stats()}")
+
+empty_routes = np.diff(route_miles.indptr) == 0
+if empty_routes.any():
+    print(f"[!] All segment points fell outside ZCTAs after join for {empty_routes.sum()} routes")
+
+# === Fan routed miles back out to the OD rows ===
+# Every collapsed OD row counts once, as in the per-row version of this script
+fanout_df = fanout_df[fanout_df['route_key'].isin(route_pos.index)]
+miles = route_miles[route_pos.loc[fanout_df['route_key'].to_numpy()].to_numpy()]
+miles = (sparse.diags(fanout_df['n_rows'].to_numpy(dtype=float)) @ miles).tocsr()
+factors = fanout_df[FACTOR_COLS].to_numpy(dtype=float)
+
+# Persist the miles per (origin block group, origin ZIP, destination ZIP, receptor ZIP) so that other emission
+# factor tables (e.g. EV scenarios) can be evaluated with vmt_tensor.py without routing again
+vmt = build_vmt_tensor(fanout_df, miles, attributor.codes)
+save_vmt_tensor(vmt, os.path.join("emissions_outputs", "vmt_attribution_google.parquet"))
+print(f"[✓] VMT attribution tensor saved ({len(vmt)} rows)")
 
 # === Post-processing and Output Aggregation ===
-records_A, records_B, records_C = [], [], []
-
-for r in results:
-    if 'error' in r or r['origin_zip'] is None or r['dest_zip'] is None:
-        continue
-    origin_zip = r['origin_zip']
-    dest_zip = r['dest_zip']
-
-    for entry in r['emissions_by_zip']:
-        receptor_zip = entry['zip']
-
-        # A: Emissions by ZIP as receptor
-        records_A.append({'zip': receptor_zip, **entry})
-
-        # B: Origin ZIP causes these emissions
-        records_B.append({'origin_zip': origin_zip, 'receptor_zip': receptor_zip, **entry})
-
-        # C: Destination ZIP causes these emissions
-        records_C.append({'dest_zip': dest_zip, 'receptor_zip': receptor_zip, **entry})
-
-# === Convert to DataFrames and Aggregate ===
-if records_A:
-    df_A = pd.DataFrame(records_A).groupby('zip')[['PM25', 'SOx', 'NOX', 'VOC', 'NH3', 'CO2']].sum().reset_index()
-else:
-    df_A = pd.DataFrame()
-if records_B:
-    df_B = pd.DataFrame(records_B).groupby('origin_zip')[['PM25', 'SOx', 'NOX', 'VOC', 'NH3', 'CO2']].sum().reset_index()
-else:
-    df_B = pd.DataFrame()
-if records_C:
-    df_C = pd.DataFrame(records_C).groupby('dest_zip')[['PM25', 'SOx', 'NOX', 'VOC', 'NH3', 'CO2']].sum().reset_index()
-else:
-    df_C = pd.DataFrame()
-# If you want D later, uncomment the block you already have.
+# Distance is multiplied by the per-mile emission factors and accumulated per receptor, origin and destination ZIP
+aggregator = EmissionAggregator(attributor.codes, pd.concat([fanout_df['h_zcta'], fanout_df['w_zcta']]))
+aggregator.add(fanout_df['h_zcta'].to_numpy(), fanout_df['w_zcta'].to_numpy(), miles, factors)
+df_A = aggregator.receptor_table()
+df_B = aggregator.origin_table()
+df_C = aggregator.destination_table()
+# df_D = aggregator.matrix_table() # uncomment together with the D output below
 
 # === Save to CSV with confirmation ===
 output_dir = "emissions_outputs"
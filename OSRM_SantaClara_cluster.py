@@ -1,34 +1,103 @@
 #This is the final model file, which will take the necessary 
 
 # This is the final script, made to run on the great lakes cluster using the OSRM method. It will take previous 
-import requests
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
-from geopy.distance import geodesic
-import polyline
+from scipy import sparse
 import time
 import pprint
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import os
+import signal
+import sys
+from route_cache import DEFAULT_CACHE_PATH, RouteCache, OSRM_PROFILE, shard_cache_path
+from routing_client import OSRMClient, DEFAULT_OSRM_URL
+from attribution_pool import AttributionPool, default_processes
+from segment_attribution import SegmentAttributor
+from async_routing import route_stream
+from zcta_index import load_zcta_index
+from od_compaction import compact_od, report_compaction
+from vmt_tensor import build_vmt_tensor, save_vmt_tensor
+from emission_factors import FACTOR_COLS, BLOCK_GROUP_COL, join_emission_factors, report_missing_factors
+from sharding import COMPLETE_MARKER, parse_shard, shard_of, shard_dir
+from route_checkpoint import RouteCheckpoint, Progress, routes_fingerprint
+from emission_aggregator import EmissionAggregator
+from interchange import read_table
+from county_batch import county_data_paths
+from geometry_cache import source_hash
+from road_router import PRISECROADS_SHP, RoadGraph
+from road_class import RoadClassifier, build_class_vmt_tensor, receptor_class_table
+
+# === Attribution settings ===
+ATTRIBUTION_BATCH_SIZE = 2000 # number of routes attributed to ZIPs per task of the attribution process pool
+ATTRIBUTION_PROCESSES = default_processes() # attribution worker processes, SLURM_CPUS_PER_TASK on the cluster
+MAX_WORKERS = 4 # number of routing requests in flight, can be changed as needed (timeouts, connection resets and 5xx answers are retried by OSRMClient)
+AGGREGATION_CHUNK_SIZE = 100000 # OD rows added to the emission aggregator at once
+PROGRESS_EVERY = 60 # seconds between progress reports during routing
+DISTANCE_MODE = 'vincenty' # 'vincenty' matches geopy's geodesic, 'haversine' is faster and within 0.25% (see distance_kernel.py)
+PREDICATE = 'within' # midpoints on a ZIP boundary are not attributed, the Google script uses the more forgiving 'intersects'
+ASSIGNMENT = 'midpoint' # 'midpoint' gives each segment to the ZIP of its midpoint, 'clip' splits it exactly at ZIP boundaries (see clip_benchmark.py)
+
+# SLURM sends SIGTERM before killing a job at walltime: exit through SystemExit so the exit handlers run and the
+# attribution workers are terminated with the job (checkpointed routes are kept for --resume)
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
 
 # === Set data path ===
+# Santa Clara inputs by default, `--county <GEOID>` reads the products of county_batch.py for that county and
+# `--data-dir <folder>` a folder with the same files. Outputs of another county go to emissions_outputs/<county>.
 PATH = "data/"
+COUNTY_DATA = county_data_paths(sys.argv[1:])
+if COUNTY_DATA is None:
+    OUTPUT_ROOT = "emissions_outputs"
+    ZCTA_INDEX_PATH = f"{PATH}zcta_index_06085.parquet"
+    GEOIDS_PATH = f"{PATH}santa_clara_geoids.parquet"
+    EMISSIONS_PATH = f"{PATH}avg_emissions_per_geoid_SantaClara.parquet"
+else:
+    county_name, county_paths = COUNTY_DATA
+    OUTPUT_ROOT = os.path.join("emissions_outputs", county_name)
+    ZCTA_INDEX_PATH, GEOIDS_PATH, EMISSIONS_PATH = county_paths['zcta_index'], county_paths['geoids'], county_paths['emissions']
+    print(f"Running county {county_name}, outputs in {OUTPUT_ROOT}")
+
+# === Shard mode ===
+# `--shard i/N` (or a SLURM job array) processes only the routes of shard i and writes partial outputs to
+# <output root>/shards/, which are summed into the final outputs by merge_shards.py <output root>
+SHARD, N_SHARDS = parse_shard(sys.argv[1:])
+RESUME = '--resume' in sys.argv[1:] # keep the routes checkpointed by a previous (crashed or killed) run
+OFFLINE = '--offline' in sys.argv[1:] # route on the TIGER primary/secondary roads graph (road_router.py) instead of an OSRM server
+SPLIT_ROAD_CLASSES = '--road-classes' in sys.argv[1:] # also split the VMT per ZIP by road class (road_class.py)
+if N_SHARDS > 1:
+    output_dir = shard_dir(OUTPUT_ROOT, SHARD, N_SHARDS)
+    print(f"Running shard {SHARD} of {N_SHARDS}, outputs in {output_dir}")
+    if os.path.exists(os.path.join(output_dir, COMPLETE_MARKER)):
+        os.remove(os.path.join(output_dir, COMPLETE_MARKER)) # a re-run shard is incomplete until it finishes again
+else:
+    output_dir = OUTPUT_ROOT
 
 # === Load Required Data ===
+# GEOIDs are already typed (zero-padded strings) in the Parquet files, only the columns used here are read
+OD_COLUMNS = ['h_geocode', 'w_geocode', 'Number of Cars', 'home_lat', 'home_lon', 'work_lat', 'work_lon', 'h_zcta', 'w_zcta']
 start_time = time.time()
-zcta = gpd.read_file(f"{PATH}tl_2023_us_zcta520/tl_2023_us_zcta520.shp").to_crs(epsg=4326) # reads US tiger shapefiles for ZIP code areas
-od_df = pd.read_csv(f"{PATH}santa_clara_geoids.csv") # reads selected county GEOID dataset
-od_df['h_geocode'] = od_df['h_geocode'].astype(str)
-od_df['h_geocode'] = od_df['h_geocode'].str.zfill(15)
-emissions_df = pd.read_csv(f"{PATH}avg_emissions_per_geoid_SantaClara.csv") # reads avg emissions per GEOID for selected county dataset
-emissions_df['Census Block Group Code'] = (
-    emissions_df['Census Block Group Code']
-    .astype(str)
-    .str.zfill(12)
-)
+zcta_index = load_zcta_index(ZCTA_INDEX_PATH) # reads county ZIP code areas prepared by zcta_index.py, used to attribute route miles
+od_df = read_table(GEOIDS_PATH, columns=OD_COLUMNS) # reads selected county GEOID dataset, with home/work ZIPs from GEOIDtocoord.py
+emissions_df = read_table(EMISSIONS_PATH, columns=[BLOCK_GROUP_COL] + FACTOR_COLS) # reads avg emissions per GEOID for selected county dataset
 print(f"Data loading time: {time.time() - start_time:.2f} seconds") # output loading time for data, can be commented out 
+
+# === Join emission factors to the OD table ===
+# Factors of the home block group are attached to every OD row once, rows without factors are reported and skipped
+od_df, missing_factors = join_emission_factors(od_df, emissions_df)
+report_missing_factors(missing_factors)
+
+# === Route cache ===
+# Routes are stored on disk so that re-runs (e.g. with new emission factors) do not call OSRM again.
+# Set OSRM_EXTRACT_VERSION to the OSM extract used to build the OSRM graph, so routes from an older extract are evicted.
+# A shard reads the shared cache and stores its new routes in its own file, merged into the shared one by merge_shards.py
+if N_SHARDS > 1:
+    route_cache = RouteCache(shard_cache_path(DEFAULT_CACHE_PATH, SHARD, N_SHARDS), version=os.environ.get("OSRM_EXTRACT_VERSION", ""),
+                             shared_path=DEFAULT_CACHE_PATH)
+else:
+    route_cache = RouteCache(DEFAULT_CACHE_PATH, version=os.environ.get("OSRM_EXTRACT_VERSION", ""))
+print(f"Evicted {route_cache.evict(OSRM_PROFILE, keep_version=route_cache.version)} routes from older OSRM extracts")
+
 # print(emissions_df['Census Block Group Code'].head())
 # print(emissions_df['Census Block Group Code'].str.len().value_counts())
 
@@ -37,24 +106,37 @@ print(f"Data loading time: {time.time() - start_time:.2f} seconds") # output loa
 print(od_df[['home_lat','home_lon','work_lat','work_lon']].isna().sum())
 print(od_df.head())
 print(len(od_df))
-# === Emissions calculation per OD pair ===
+
+# === OSRM routing client ===
+# Pooled HTTP session with timeouts and retries with backoff, shared by all worker threads
+osrm_client = OSRMClient(os.environ.get("OSRM_URL", DEFAULT_OSRM_URL), pool_size=MAX_WORKERS)
+fetch_route_polyline_osrm = osrm_client.route_polyline
+
+# === Offline road graph ===
+# With --offline, routes are shortest paths on the road graph of the ZCTA index area (built once, cached in data/road_graph)
+if OFFLINE:
+    t_graph = time.time()
+    road_graph = RoadGraph.load(bbox=tuple(zcta_index.gdf.total_bounds))
+    print(f"Road graph: {len(road_graph.node_lat)} nodes, {road_graph.graph.nnz} edges ({time.time() - t_graph:.2f} seconds)")
+
+# === Compact OD pairs into unique routes ===
+# Rows sharing the same home/work centroids are routed once, their cars are summed and fanned back out after routing
+routes_df, fanout_df = compact_od(od_df, attribution_cols=['block_group', 'h_zcta', 'w_zcta'])
+report_compaction(len(od_df), routes_df)
+if N_SHARDS > 1:
+    # Routes are assigned to shards by their coordinates, the OD rows of a route follow it in fanout_df
+    routes_df = routes_df[shard_of(routes_df, N_SHARDS) == SHARD]
+    fanout_df = fanout_df[fanout_df['route_key'].isin(routes_df.index)]
+    print(f"Shard {SHARD}: {len(routes_df)} unique routes, {int(fanout_df['n_rows'].sum())} OD rows")
+
+# === Route geometry per unique OD pair ===
 def process_route(idx_row):
     idx, row = idx_row
-    # Extract origin and destination coordinates from OD dataframe row
+    # Extract origin and destination coordinates from the unique route row
     origin = (row['home_lat'], row['home_lon'])
     destination = (row['work_lat'], row['work_lon'])
 
-    # Takes first 12 digits of h_geocode
-    origin_tract = row['h_geocode'][:12]
-
-
-    # Filter emissions_df for a matching GEOID
-    emission_row = emissions_df[emissions_df['Census Block Group Code'] == origin_tract]
-    if emission_row.empty:
-        return {'route_idx': idx, 'error': f"No emissions data for GEOID {origin_tract}"}
-    emissions = emission_row.iloc[0]
-    
-        # --- Validate coordinates before calling OSRM ---
+    # --- Validate coordinates before calling OSRM ---
     if (
         pd.isna(origin[0]) or pd.isna(origin[1]) or
         pd.isna(destination[0]) or pd.isna(destination[1])
@@ -69,166 +151,122 @@ def process_route(idx_row):
         return {'route_idx': idx, 'error': 'Invalid longitude values'}
     
     try:
-        # OSRM request URL with origin and destination coordinates and server call 
-        osrm_url = f"http://localhost:5000/route/v1/driving/{origin[1]},{origin[0]};{destination[1]},{destination[0]}?overview=full&geometries=polyline"
-        response = requests.get(osrm_url)
-        # print("Status code:", response.status_code)
-        # print("URL:", osrm_url)
-        # print("Raw response:", response.text[:300])
-        route_data = response.json()
-
-        if 'routes' not in route_data or not route_data['routes']:
-            return {'route_idx': idx, 'error': "OSRM routing failed"}
-
-        # Decode polyline geometry into a list of latitude and longitude points
-        route_coords = polyline.decode(route_data['routes'][0]['geometry'])
-
-        # List of route segments is built
-        segments = []
-        for a, b in zip(route_coords[:-1], route_coords[1:]):
-            distance = geodesic(a, b).miles
-            midpoint_geom = Point((a[1] + b[1]) / 2, (a[0] + b[0]) / 2)
-            segments.append({'geometry': midpoint_geom, 'distance_miles': distance})
-
-        if not segments:
-            return {'route_idx': idx, 'error': "No route segments"}
-
-        seg_df = pd.DataFrame(segments)
-        seg_gdf = gpd.GeoDataFrame(data=seg_df, geometry='geometry', crs='EPSG:4326')
-
-        # Assigns a ZIP code to each segment point 
-        seg_gdf = gpd.sjoin(seg_gdf, zcta[['ZCTA5CE20', 'geometry']], how='left', predicate='within')
-        seg_gdf = seg_gdf.dropna(subset=['ZCTA5CE20'])
-
-        # Multiply distance_miles by number of cars on route
-        num_cars = row['Number of Cars']
-        seg_gdf['distance_miles'] = seg_gdf['distance_miles'] * num_cars
-
-        # Aggregate total travel miles per ZIP
-        zip_dist = seg_gdf.groupby('ZCTA5CE20')['distance_miles'].sum().reset_index()
-
-        # Multiply distance by per-mile emission factors to get emissions on each ZIP
-        pollutants = ['PM25_per_mile', 'SOx_per_mile', 'NOX_per_mile',
-                      'VOC_per_mile', 'NH3_per_mile', 'CO2_per_mile']
-        for pollutant in pollutants:
-            zip_dist[f'{pollutant}_emissions'] = zip_dist['distance_miles'] * emissions[pollutant]
-
-        # Finds route origin ZIP 
-        origin_point = Point(origin[1], origin[0])
-        origin_zip_match = zcta[zcta.contains(origin_point)]
-        origin_zip = origin_zip_match.iloc[0]['ZCTA5CE20'] if not origin_zip_match.empty else None
-
-        # Finds route destination ZIP 
-        dest_point = Point(destination[1], destination[0])
-        dest_zip_match = zcta[zcta.contains(dest_point)]
-        dest_zip = dest_zip_match.iloc[0]['ZCTA5CE20'] if not dest_zip_match.empty else None
-
-        # Build list of per-ZIP emissions for the current route
-        emissions_by_zip = []
-        for _, row_zip in zip_dist.iterrows():
-            emissions_by_zip.append({
-                'zip': row_zip['ZCTA5CE20'],
-                'PM25': row_zip['PM25_per_mile_emissions'],
-                'SOx': row_zip['SOx_per_mile_emissions'],
-                'NOX': row_zip['NOX_per_mile_emissions'],
-                'VOC': row_zip['VOC_per_mile_emissions'],
-                'NH3': row_zip['NH3_per_mile_emissions'],
-                'CO2': row_zip['CO2_per_mile_emissions']
-            })
-
-        # Return result with origin/destination ZIP and emissions breakdown
-        return {
-            'route_idx': idx,
-            'origin_zip': origin_zip,
-            'dest_zip': dest_zip,
-            'emissions_by_zip': emissions_by_zip
-        }
+        # Route geometry comes from the cache, OSRM is only called for routes that were never computed
+        encoded = route_cache.get_or_fetch(OSRM_PROFILE, origin, destination, fetch_route_polyline_osrm)
+
+        # Encoded geometry is returned as is, decoding and attribution run in the process pool
+        return {'route_idx': idx, 'encoded': encoded}
 
     except Exception as e:
         return {'route_idx': idx, 'error': str(e)}
 
-# === Run parallel routing with ThreadPool ===
-results = []
-t_parallel = time.time()
-with ThreadPoolExecutor(max_workers=4) as executor: # number of max workers can be changed as needed, through my tests there tended to be errors when using more then 2 workers in the cluster
-    #futures = [executor.submit(process_route, item) for item in od_df.head(100).iterrows()] #uncomment if want to run for less OD pairs and change the number in head()
-    futures = [executor.submit(process_route, item) for item in od_df.iterrows()] # comment if not running for entire dataset
-    for future in as_completed(futures):
-        results.append(future.result())
-
-print(f"Total execution time: {time.time() - t_parallel:.2f} seconds")
-
-for r in results:
+# === Checkpoint ===
+# Attributed routes are appended to Parquet chunks in the output folder as each batch finishes,
+# with --resume the routes of a previous run are read back and skipped. The checkpoint is only resumed by a run with
+# the same routes and the same attribution settings, ZCTA index and road network.
+ATTRIBUTION_SETTINGS = {
+    'predicate': PREDICATE,
+    'distance_mode': DISTANCE_MODE,
+    'assignment': ASSIGNMENT,
+    'router': f"road_graph:{source_hash(PRISECROADS_SHP)}" if OFFLINE else f"osrm:{route_cache.version}",
+    'road_classes': source_hash(PRISECROADS_SHP) if SPLIT_ROAD_CLASSES else None,
+    'zcta_index': source_hash(ZCTA_INDEX_PATH),
+}
+fingerprint = routes_fingerprint(routes_df, ATTRIBUTION_SETTINGS)
+# With --road-classes the miles split by road class are written in the same checkpoint chunks as the ZIP miles
+checkpoint = RouteCheckpoint(os.path.join(output_dir, "checkpoint"), zcta_index.codes, fingerprint, resume=RESUME,
+                             road_classes=SPLIT_ROAD_CLASSES)
+resumed_keys, resumed_miles, resumed_class_miles = checkpoint.load()
+pending_df = routes_df[~routes_df.index.isin(resumed_keys)]
+if RESUME:
+    print(f"Resuming from checkpoint: {len(resumed_keys)} routes done, {len(pending_df)} left")
+progress = Progress(len(routes_df), done=len(resumed_keys), every=PROGRESS_EVERY)
+
+# === Road classes ===
+# With --road-classes, segment midpoints are snapped to the nearest primary/secondary road by the attribution workers
+road_classifier = RoadClassifier.load(bbox=tuple(zcta_index.gdf.total_bounds)) if SPLIT_ROAD_CLASSES else None
+
+# === Streaming routing and segment-to-ZIP attribution ===
+# OD rows are streamed to a bounded number of in-flight routing calls, every routed polyline is handed to the
+# attribution process pool as it arrives, where segment midpoints are assigned to ZIPs in batches on all cores.
+# The pool is created (and its workers forked, inheriting the attributor) before any routing thread starts.
+attributor = SegmentAttributor.from_index(zcta_index, predicate=PREDICATE, distance_mode=DISTANCE_MODE,
+                                          road_classifier=road_classifier, assignment=ASSIGNMENT)
+attribution = AttributionPool(attributor, processes=ATTRIBUTION_PROCESSES, batch_size=ATTRIBUTION_BATCH_SIZE,
+                              on_batch=checkpoint.write)
+n_errors = 0
+
+def collect_route(r):
+    global n_errors
+    progress.update()
     if 'error' in r:
+        n_errors += 1
         print("ERROR:", r['error'])
+    else:
+        attribution.add(r['route_idx'], r['encoded'])
 
-# === Post-processing and Output Aggregation ===
-records_A = []  # Total emissions per ZIP (receptor)
-records_B = []  # Emissions caused by origin ZIP
-records_C = []  # Emissions caused by destination ZIP
-records_D = []  # ZIP-to-ZIP matrix (origin → receptor)
-
-for r in results:
-    if 'error' in r or r['origin_zip'] is None or r['dest_zip'] is None:
-        continue
-    origin_zip = r['origin_zip']
-    dest_zip = r['dest_zip']
-
-    for entry in r['emissions_by_zip']:
-        receptor_zip = entry['zip']
-
-        # A: Emissions by ZIP as receptor
-        records_A.append({
-            'zip': receptor_zip,
-            **entry
-        })
-
-        # B: Origin ZIP causes these emissions
-        records_B.append({
-            'origin_zip': origin_zip,
-            'receptor_zip': receptor_zip,
-            **entry
-        })
-
-        # C: Destination ZIP causes these emissions
-        records_C.append({
-            'dest_zip': dest_zip,
-            'receptor_zip': receptor_zip,
-            **entry
-        })
-
-        # D: Matrix of origin → receptor
-        records_D.append({
-            'origin_zip': origin_zip,
-            'receptor_zip': receptor_zip,
-            'PM25': entry['PM25'],
-            'SOx': entry['SOx'],
-            'NOX': entry['NOX'],
-            'VOC': entry['VOC'],
-            'NH3': entry['NH3'],
-            'CO2': entry['CO2']
-        })
-
-# === Convert to DataFrames and Aggregate ===
-if records_A:
-	df_A = pd.DataFrame(records_A).groupby('zip')[['PM25', 'SOx', 'NOX', 'VOC', 'NH3', 'CO2']].sum().reset_index()
-else:
-	df_A = pd.DataFrame()
-if records_B:
-	df_B = pd.DataFrame(records_B).groupby('origin_zip')[['PM25', 'SOx', 'NOX', 'VOC', 'NH3', 'CO2']].sum().reset_index()
-else: 
-	df_B = pd.DataFrame()
-if records_C:
-	df_C = pd.DataFrame(records_C).groupby('dest_zip')[['PM25', 'SOx', 'NOX', 'VOC', 'NH3', 'CO2']].sum().reset_index()
-else:
-	df_C = pd.DataFrame()
-if records_D:
-	df_D = pd.DataFrame(records_D).groupby(['origin_zip', 'receptor_zip'])[['PM25', 'SOx', 'NOX', 'VOC', 'NH3', 'CO2']].sum().reset_index()
+t_parallel = time.time()
+if OFFLINE:
+    # One shortest-path tree per origin node serves all the routes leaving it, no routing server involved
+    for idx, encoded in road_graph.route_polylines(pending_df):
+        collect_route({'route_idx': idx, 'encoded': encoded} if encoded is not None else {'route_idx': idx, 'error': 'No path on the road network'})
 else:
-	df_D = pd.DataFrame()
+    #route_stream(pending_df.head(100).iterrows(), process_route, collect_route, max_in_flight=MAX_WORKERS) #uncomment if want to run for less OD pairs and change the number in head()
+    route_stream(pending_df.iterrows(), process_route, collect_route, max_in_flight=MAX_WORKERS) # comment if not running for entire dataset
+routed_keys, route_miles = attribution.result()
+progress.report()
+routed_keys = list(resumed_keys) + list(routed_keys)
+route_miles = sparse.vstack([resumed_miles, route_miles], format='csr')
+if SPLIT_ROAD_CLASSES:
+    route_class_miles = sparse.vstack([resumed_class_miles, attribution.class_result()], format='csr')
+n_errors += attribution.n_dropped # routes without any segment
+route_pos = pd.Series(np.arange(len(routed_keys)), index=routed_keys)
+
+print(f"Total execution time: {time.time() - t_parallel:.2f} seconds ({len(routed_keys)} routed, {n_errors} errors)")
+print(f"Route cache: {route_cache.stats()}")
+route_cache.close() # folds the write-ahead log into the cache file, which shards read without it
+
+# === Fan routed miles back out to the OD rows ===
+t_fanout = time.time()
+# Miles per (OD row, ZIP) are the miles of its route multiplied by the number of cars of the row
+fanout_df = fanout_df[fanout_df['route_key'].isin(route_pos.index)]
+miles = route_miles[route_pos.loc[fanout_df['route_key'].to_numpy()].to_numpy()]
+miles = (sparse.diags(fanout_df['Number of Cars'].to_numpy(dtype=float)) @ miles).tocsr()
+factors = fanout_df[FACTOR_COLS].to_numpy(dtype=float)
+
+# Persist the miles per (origin block group, origin ZIP, destination ZIP, receptor ZIP) so that other emission
+# factor tables (e.g. EV scenarios) can be evaluated with vmt_tensor.py without routing again
+vmt = build_vmt_tensor(fanout_df, miles, zcta_index.codes)
+save_vmt_tensor(vmt, os.path.join(output_dir, "vmt_attribution.parquet"))
+print(f"[✓] VMT attribution tensor saved ({len(vmt)} rows)")
+
+if SPLIT_ROAD_CLASSES:
+    # Same tensor with a road_class column, and the miles per receptor ZIP and road class
+    class_miles = route_class_miles[route_pos.loc[fanout_df['route_key'].to_numpy()].to_numpy()]
+    class_miles = (sparse.diags(fanout_df['Number of Cars'].to_numpy(dtype=float)) @ class_miles).tocsr()
+    vmt_by_class = build_class_vmt_tensor(fanout_df, class_miles, zcta_index.codes)
+    save_vmt_tensor(vmt_by_class, os.path.join(output_dir, "vmt_attribution_by_road_class.parquet"))
+    receptor_class_table(vmt_by_class).to_csv(os.path.join(output_dir, "receptor_zip_vmt_by_road_class.csv"), index=False)
+    print(f"[✓] Road-class VMT tensor saved ({len(vmt_by_class)} rows)")
+
+print(f"Fan-out time: {time.time() - t_fanout:.2f} seconds")
+
+# === Post-processing and Output Aggregation ===
+# Distance is multiplied by the per-mile emission factors and accumulated per receptor ZIP (A), origin ZIP (B),
+# destination ZIP (C) and origin -> receptor ZIP (D), chunk by chunk of OD rows
+t_aggregation = time.time()
+aggregator = EmissionAggregator(zcta_index.codes, pd.concat([fanout_df['h_zcta'], fanout_df['w_zcta']]))
+for start in range(0, len(fanout_df), AGGREGATION_CHUNK_SIZE):
+    chunk = slice(start, start + AGGREGATION_CHUNK_SIZE)
+    aggregator.add(fanout_df['h_zcta'].to_numpy()[chunk], fanout_df['w_zcta'].to_numpy()[chunk], miles[chunk], factors[chunk])
+
+df_A = aggregator.receptor_table()
+df_B = aggregator.origin_table()
+df_C = aggregator.destination_table()
+df_D = aggregator.matrix_table()
+print(f"Aggregation time: {time.time() - t_aggregation:.2f} seconds")
 
 # === Save to CSV with confirmation ===
-output_dir = "emissions_outputs"
 os.makedirs(output_dir, exist_ok=True)
 
 def save_with_check(df, filename, label):
@@ -243,3 +281,7 @@ save_with_check(df_A, "receptor_zip_emissions.csv", "Total emissions per ZIP (re
 save_with_check(df_B, "origin_zip_emissions.csv", "Total emissions caused by origin ZIP")
 save_with_check(df_C, "destination_zip_emissions.csv", "Total emissions caused by destination ZIP")
 save_with_check(df_D, "zip_to_zip_emissions_matrix.csv", "ZIP-to-ZIP emissions matrix")
+
+# Marks the shard as finished for merge_shards.py
+if N_SHARDS > 1:
+    open(os.path.join(output_dir, COMPLETE_MARKER), "w").close()
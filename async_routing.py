@@ -0,0 +1,43 @@
+# asyncio routing driver with a bounded number of in-flight requests.
+# A producer streams OD rows into a bounded queue (backpressure: it waits while the queue is full), a fixed pool of
+# consumers routes them, and each result is handed to a callback as soon as it arrives (e.g. the streaming
+# attribution stage), so memory stays flat whatever the number of OD pairs. The number of consumers bounds the
+# requests in flight, keeping the OSRM server saturated without overloading it.
+# Routing functions are blocking (requests based), they run in a thread pool owned by the driver.
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+async def _route_all(items, route_one, on_result, max_in_flight, queue_size):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+    done = object()
+
+    async def producer():
+        for item in items:
+            await queue.put(item)
+        for _ in range(max_in_flight):
+            await queue.put(done)
+
+    async def consumer(executor):
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            result = await loop.run_in_executor(executor, route_one, item)
+            on_result(result)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        await asyncio.gather(producer(), *(consumer(executor) for _ in range(max_in_flight)))
+
+
+def route_stream(items, route_one, on_result, max_in_flight=4, queue_size=None):
+    """
+    Route every item with at most max_in_flight concurrent calls.
+
+    items: iterable (consumed lazily), e.g. routes_df.iterrows().
+    route_one: blocking function called with one item, returns a result dict.
+    on_result: called in the event loop thread with every result, in completion order.
+    queue_size: number of items read ahead of the consumers (default 2 * max_in_flight).
+    """
+    asyncio.run(_route_all(items, route_one, on_result, max_in_flight, queue_size or 2 * max_in_flight))
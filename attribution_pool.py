@@ -0,0 +1,133 @@
+# Process-pool CPU stage for route attribution.
+# Routing threads only fetch encoded polylines (network I/O); polyline decoding, segment lengths and the
+# segment-to-ZCTA spatial query run in a multiprocessing pool, in batches, so attribution scales across all cores
+# of the node instead of being capped at one core by the GIL. The SegmentAttributor (ZCTA polygons, STRtree and the
+# optional road classifier, see road_class.py) is built once by the parent and inherited by the forked workers, which
+# only read it: its pages stay shared copy-on-write, no worker loads or rebuilds the polygons. The trees and prepared
+# polygons are built in the parent before the fork, as GEOS would otherwise build them in every worker on first use.
+#
+# The pool uses the fork start method (Linux, as on Great Lakes) and starts its workers when it is created, so it
+# must be created before the routing threads start.
+import multiprocessing
+import os
+
+import polyline
+import shapely
+from scipy import sparse
+
+from road_class import RoadClassifier, collapse_classes
+from segment_attribution import pack_routes
+
+# Attributor of the current worker process, set by _init_worker
+_attributor = None
+
+
+def _init_worker(attributor):
+    # With fork the attributor is not pickled, the worker keeps the object of the parent
+    global _attributor
+    _attributor = attributor
+
+
+def _build_trees(attributor):
+    """Build the STRtrees and prepare the polygons in the parent, so the forked workers share them."""
+    point = shapely.points([0.0], [0.0])
+    shapely.prepare(attributor.tree.geometries)
+    attributor.tree.query(point, predicate='intersects')
+    if attributor.road_classifier is not None:
+        attributor.road_classifier.tree.query_nearest(point, max_distance=attributor.road_classifier.snap_distance)
+
+
+def _attribute_batch(batch):
+    """
+    Decode and attribute a batch of (route_idx, encoded polyline).
+    Returns (route_keys, miles, class_miles, n_dropped), class_miles is None without road classifier.
+    """
+    keys, coords = [], []
+    for route_idx, encoded in batch:
+        route_coords = polyline.decode(encoded)
+        if len(route_coords) >= 2:
+            keys.append(route_idx)
+            coords.append(route_coords)
+    lat, lon, offsets = pack_routes(coords)
+    if _attributor.road_classifier is None:
+        return keys, _attributor.attribute(lat, lon, offsets), None, len(batch) - len(keys)
+    class_miles = _attributor.attribute_by_class(lat, lon, offsets)
+    return keys, collapse_classes(class_miles, len(_attributor.codes)), class_miles, len(batch) - len(keys)
+
+
+def default_processes():
+    """CPUs allocated by SLURM when running on the cluster, all CPUs of the machine otherwise."""
+    return int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count() or 1))
+
+
+class AttributionPool:
+    """
+    Streams encoded polylines to a pool of attribution processes. Same add/flush/result interface as
+    segment_attribution.StreamingAttribution (used by the Google script), but add() takes the encoded polyline,
+    which is decoded in the workers.
+
+    Args:
+        attributor: segment_attribution.SegmentAttributor used by every worker (with its road classifier, if any).
+        processes: number of worker processes (default_processes() if None).
+        batch_size: number of routes per task sent to a worker.
+        max_pending: maximum number of batches waiting in the pool before add() blocks (backpressure).
+        on_batch: optional callback called with (route_keys, miles, class_miles) of every finished batch, e.g. to
+            checkpoint it (class_miles is None without road classifier).
+    """
+
+    def __init__(self, attributor, processes=None, batch_size=2000, max_pending=None, on_batch=None):
+        self.processes = processes or default_processes()
+        self.batch_size = batch_size
+        self.max_pending = max_pending or 2 * self.processes
+        self.n_zcta = len(attributor.codes)
+        self.n_dropped = 0
+        self.on_batch = on_batch
+
+        _build_trees(attributor)
+        ctx = multiprocessing.get_context("fork")
+        self._pool = ctx.Pool(self.processes, initializer=_init_worker, initargs=(attributor,))
+        self._batch = []
+        self._pending = []
+        self._keys = []
+        self._miles = []
+        self._class_miles = []
+
+    def add(self, route_idx, encoded):
+        self._batch.append((route_idx, encoded))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self._pending.append(self._pool.apply_async(_attribute_batch, (self._batch,)))
+            self._batch = []
+        # Wait for the oldest batches when too many are queued, so memory stays bounded
+        while len(self._pending) > self.max_pending:
+            self._collect(self._pending.pop(0))
+
+    def _collect(self, pending):
+        keys, miles, class_miles, n_dropped = pending.get()
+        self._keys.extend(keys)
+        self._miles.append(miles)
+        self.n_dropped += n_dropped
+        if class_miles is not None:
+            self._class_miles.append(class_miles)
+        if self.on_batch is not None:
+            self.on_batch(keys, miles, class_miles)
+
+    def result(self):
+        """Wait for every batch and return (route_keys, sparse route x ZCTA miles matrix)."""
+        self.flush()
+        while self._pending:
+            self._collect(self._pending.pop(0))
+        self._pool.close()
+        self._pool.join()
+        if not self._miles:
+            return [], sparse.csr_matrix((0, self.n_zcta))
+        return self._keys, sparse.vstack(self._miles, format='csr')
+
+    def class_result(self):
+        """Sparse route x (ZCTA, road class) miles matrix, rows in the order of the keys of result()."""
+        if not self._class_miles:
+            return sparse.csr_matrix((0, self.n_zcta * RoadClassifier.n_classes))
+        return sparse.vstack(self._class_miles, format='csr')
@@ -0,0 +1,152 @@
+# Benchmark of the ZCTA assignment modes of segment_attribution.SegmentAttributor.
+# The same routes are attributed with the per-route GeoPandas sjoin of the original scripts, the batched midpoint
+# assignment ('within' as in the OSRM script, 'intersects' as in the Google script) and the exact 'clip' assignment,
+# and the timings and the differences in attributed miles are printed.
+# Routes are read from a route cache (real OSRM/Google geometries) when one is given, otherwise synthetic zigzag
+# routes between random points of the ZCTA index area are used.
+# With --grid the ZCTA index is replaced by a grid of square cells over the Santa Clara county area, and a quarter of
+# the synthetic routes run along the cell edges, as streets that are ZIP boundaries do (shared edges in 'clip').
+#
+# Usage:
+#   python clip_benchmark.py [n_routes] [route_cache.sqlite] [--grid]
+import sqlite3
+import sys
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import polyline
+import shapely
+
+from distance_kernel import route_miles
+from segment_attribution import SegmentAttributor, pack_routes
+from zcta_index import OUTPUT_INDEX, ZCTAIndex, load_zcta_index
+
+BATCH_SIZE = 2000
+GRID_BBOX = (-122.2, 36.9, -121.2, 37.5) # Santa Clara county bounds, lon/lat
+GRID_CELL_DEG = 0.04                     # ~4 km cells, about the size of an urban ZCTA
+
+
+def cached_routes(path, n):
+    """Up to n decoded route geometries of a route_cache.RouteCache database."""
+    with sqlite3.connect(path) as conn:
+        rows = conn.execute("SELECT geometry FROM routes LIMIT ?", (n,)).fetchall()
+    return [route for route in (polyline.decode(r[0]) for r in rows) if len(route) >= 2]
+
+
+def synthetic_routes(n, bbox, n_vertices=60, seed=0):
+    """n routes between random points of bbox, with alternating lateral offsets so segments cross ZCTA boundaries."""
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bbox
+    t = np.linspace(0.0, 1.0, n_vertices)
+    routes = []
+    for _ in range(n):
+        lon1, lon2 = rng.uniform(minx, maxx, 2)
+        lat1, lat2 = rng.uniform(miny, maxy, 2)
+        zigzag = np.where(np.arange(n_vertices) % 2, 0.005, -0.005)
+        zigzag[[0, -1]] = 0.0
+        routes.append(list(zip(lat1 + (lat2 - lat1) * t + zigzag, lon1 + (lon2 - lon1) * t)))
+    return routes
+
+
+def grid_index(bbox=GRID_BBOX, cell=GRID_CELL_DEG):
+    """ZCTAIndex of square cells covering bbox, neighbouring cells share their edges."""
+    minx, miny, maxx, maxy = bbox
+    x = minx + cell * np.arange(round((maxx - minx) / cell) + 1)
+    y = miny + cell * np.arange(round((maxy - miny) / cell) + 1)
+    x0, y0 = np.meshgrid(x[:-1], y[:-1])
+    x1, y1 = np.meshgrid(x[1:], y[1:])
+    cells = shapely.box(x0.ravel(), y0.ravel(), x1.ravel(), y1.ravel())
+    return ZCTAIndex(gpd.GeoDataFrame({"ZCTA5": [f"{i:05d}" for i in range(len(cells))]}, geometry=cells, crs="EPSG:4326"))
+
+
+def edge_routes(n, bbox=GRID_BBOX, cell=GRID_CELL_DEG, n_vertices=60, seed=1):
+    """n routes along the edges of the grid_index cells, alternating horizontal and vertical."""
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bbox
+    routes = []
+    for i in range(n):
+        start, end = np.sort(rng.uniform(0.0, 1.0, 2))
+        t = np.linspace(start, end, n_vertices)
+        if i % 2:
+            lon = minx + cell * rng.integers(1, round((maxx - minx) / cell))
+            routes.append([(miny + (maxy - miny) * v, lon) for v in t])
+        else:
+            lat = miny + cell * rng.integers(1, round((maxy - miny) / cell))
+            routes.append([(lat, minx + (maxx - minx) * v) for v in t])
+    return routes
+
+
+def sjoin_attribution(routes, zcta_index, predicate):
+    """Per-route midpoint sjoin, as done before segment_attribution.py. Returns a routes x ZCTA miles DataFrame."""
+    zcta = zcta_index.gdf[["ZCTA5", "geometry"]]
+    rows = []
+    for i, route in enumerate(routes):
+        a, b = np.asarray(route[:-1]), np.asarray(route[1:])
+        seg_gdf = gpd.GeoDataFrame(
+            {'distance_miles': route_miles(route)},
+            geometry=gpd.points_from_xy((a[:, 1] + b[:, 1]) / 2, (a[:, 0] + b[:, 0]) / 2), crs="EPSG:4326",
+        )
+        seg_gdf = gpd.sjoin(seg_gdf, zcta, how='left', predicate=predicate).dropna(subset=['ZCTA5'])
+        zip_dist = seg_gdf.groupby('ZCTA5')['distance_miles'].sum()
+        rows.append(zip_dist.rename(i))
+    return pd.DataFrame(rows).reindex(columns=zcta_index.codes).fillna(0.0)
+
+
+def batch_attribution(routes, attributor):
+    miles = []
+    for start in range(0, len(routes), BATCH_SIZE):
+        lat, lon, offsets = pack_routes(routes[start:start + BATCH_SIZE])
+        miles.append(attributor.attribute(lat, lon, offsets).toarray())
+    return np.vstack(miles)
+
+
+def timed(label, n_routes, fn):
+    start = time.time()
+    result = fn()
+    elapsed = time.time() - start
+    print(f"{label:<24} {elapsed:8.2f} s  {n_routes / elapsed if elapsed else float('inf'):10.1f} routes/s")
+    return np.asarray(result, dtype=float)
+
+
+def compare(label, miles, reference, total):
+    """Share of the miles moved to another ZCTA and largest per-ZCTA change, against the exact reference."""
+    moved = np.abs(miles - reference).sum() / 2
+    per_zcta, ref_zcta = miles.sum(axis=0), reference.sum(axis=0)
+    worst = np.max(np.abs(per_zcta - ref_zcta) / np.where(ref_zcta > 0, ref_zcta, np.inf)) if len(ref_zcta) else 0.0
+    print(f"{label:<24} attributed {miles.sum() / total:7.2%} of route miles, {moved / total:6.2%} in another ZCTA than 'clip', "
+          f"largest per-ZCTA difference {worst:6.2%}")
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    grid = '--grid' in sys.argv[1:]
+    n_routes = int(args[0]) if args else 2000
+    zcta_index = grid_index() if grid else load_zcta_index(OUTPUT_INDEX)
+    if len(args) > 1:
+        routes = cached_routes(args[1], n_routes)
+    elif grid:
+        routes = synthetic_routes(n_routes - n_routes // 4, GRID_BBOX) + edge_routes(n_routes // 4)
+    else:
+        routes = synthetic_routes(n_routes, zcta_index.gdf.total_bounds)
+    n_routes = len(routes)
+    total = sum(route_miles(route).sum() for route in routes)
+    print(f"{n_routes} routes, {sum(len(r) - 1 for r in routes)} segments, {total:.0f} miles, {len(zcta_index.codes)} ZCTAs")
+
+    # Polygons are prepared once before timing, as the STRtree predicate queries would do on first use
+    shapely.prepare(zcta_index.tree.geometries)
+
+    n_sjoin = min(n_routes, 200) # the per-route sjoin is slow, timed on a subset
+    timed(f"sjoin within ({n_sjoin})", n_sjoin, lambda: sjoin_attribution(routes[:n_sjoin], zcta_index, 'within'))
+    within = timed("midpoint within", n_routes, lambda: batch_attribution(routes, SegmentAttributor.from_index(zcta_index, predicate='within')))
+    intersects = timed("midpoint intersects", n_routes, lambda: batch_attribution(routes, SegmentAttributor.from_index(zcta_index, predicate='intersects')))
+    clip = timed("clip", n_routes, lambda: batch_attribution(routes, SegmentAttributor.from_index(zcta_index, assignment='clip')))
+
+    compare("midpoint within", within, clip, total)
+    compare("midpoint intersects", intersects, clip, total)
+    compare("clip", clip, clip, total)
+
+
+if __name__ == "__main__":
+    main()
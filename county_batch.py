@@ -0,0 +1,136 @@
+# Multi-county batch driver.
+# The statewide inputs (county polygons, ZCTAs, block centroids with their ZCTA, LODES and ACS tables) are loaded
+# once, then every county gets the products of the single-county chain in data/counties/<county GEOID>/:
+#   geoids.parquet                    OD rows with home and work in the county (GEOIDtocoord.py + GEOID_filter_santa_clara.py)
+#   zcta_index.parquet                buffered ZCTA index read by the routing scripts (zcta_index.py)
+#   acs.parquet, acs_zctas_used.csv   ACS rows of the ZCTAs intersecting the county (Census_ZIPcode_filtering.py)
+#   avg_emissions_per_geoid.parquet   per-mile emission factors (emissions_toymodel_SantaClara.py), only when the
+#                                     county fleet and EMFAC files exist, since both are downloaded per county
+# With --processes N, counties are processed by N forked worker processes sharing the statewide tables of the parent.
+# The routing script reads the products of one county with `--county <GEOID>` (see county_data_paths).
+#
+# Usage:
+#   python county_batch.py [county GEOID ...] [--processes N]
+import multiprocessing
+import os
+import sys
+import time
+
+import pandas as pd
+
+from Census_ZIPcode_filtering import COUNTIES_SHP, ZCTA_SHP, INPUT_DATA, STATEFP_CA, load_counties, load_zctas, zctas_in_county, read_acs
+from GEOIDtocoord import load_block_centroids, read_lodes, assign_zctas, join_centroids
+from zcta_index import BBOX_BUFFER_DEG, select_study_zctas
+from emissions_toymodel_SantaClara import load_fleet_counts, load_emfac_rates, merge_fleet_emfac, average_emissions_per_geoid
+from interchange import write_table
+
+OUTPUT_TEMPLATE = "data/counties/{county}"
+GEOIDS_FILE = "geoids.parquet"
+ZCTA_INDEX_FILE = "zcta_index.parquet"
+EMISSIONS_FILE = "avg_emissions_per_geoid.parquet"
+FLEET_TEMPLATE = "data/counties/{county}/cleaned_fleet_data.parquet" # output of fleetdatabase_santaclara.py for the county
+EMFAC_TEMPLATE = "data/counties/{county}/emfac.csv"                  # EMFAC2025 emission inventory export for the county
+
+# Statewide tables, loaded by load_statewide before the worker processes are forked
+_state = {}
+
+
+def county_data_paths(argv):
+    """
+    Input files of the routing script for `--county <GEOID>` (folder of OUTPUT_TEMPLATE) or `--data-dir <folder>` in
+    argv. Returns (name, {'geoids', 'zcta_index', 'emissions': path}), or None when neither option is given.
+    """
+    for k, arg in enumerate(argv):
+        if arg in ("--county", "--data-dir") and k + 1 < len(argv):
+            option, value = arg, argv[k + 1]
+        elif arg.startswith(("--county=", "--data-dir=")):
+            option, value = arg.split("=", 1)
+        else:
+            continue
+        folder = OUTPUT_TEMPLATE.format(county=value) if option == "--county" else value
+        if not os.path.isdir(folder):
+            raise ValueError(f"{option} {value}: no folder {folder}, run county_batch.py for this county first")
+        paths = {
+            'geoids': os.path.join(folder, GEOIDS_FILE),
+            'zcta_index': os.path.join(folder, ZCTA_INDEX_FILE),
+            'emissions': os.path.join(folder, EMISSIONS_FILE),
+        }
+        return os.path.basename(os.path.normpath(folder)), paths
+    return None
+
+
+def load_statewide(statefp=STATEFP_CA):
+    counties = load_counties(COUNTIES_SHP, statefp)
+    minx, miny, maxx, maxy = counties.total_bounds
+    zctas = load_zctas(ZCTA_SHP, bbox=(minx - BBOX_BUFFER_DEG, miny - BBOX_BUFFER_DEG, maxx + BBOX_BUFFER_DEG, maxy + BBOX_BUFFER_DEG))
+    blocks = assign_zctas(load_block_centroids(statefp), zctas)
+
+    # Only commutes within one county are kept, split by county once
+    lodes = read_lodes(statefp)
+    lodes = lodes[lodes['h_geocode'].str[:5] == lodes['w_geocode'].str[:5]]
+    lodes_by_county = dict(iter(lodes.groupby(lodes['h_geocode'].str[:5])))
+
+    acs = read_acs(INPUT_DATA) if os.path.exists(INPUT_DATA) else None
+    _state.update(counties=counties, zctas=zctas, blocks=blocks, lodes=lodes_by_county, acs=acs)
+
+
+def process_county(county):
+    """Write every product of one county, returns a one-line summary."""
+    out_dir = OUTPUT_TEMPLATE.format(county=county)
+    os.makedirs(out_dir, exist_ok=True)
+    poly = _state['counties'][_state['counties']['GEOID'] == county]
+    if poly.empty:
+        return f"{county}: not found in {COUNTIES_SHP}"
+    poly = poly.dissolve()
+
+    # OD rows with the centroids and ZCTAs of their home and work blocks
+    lodes = _state['lodes'].get(county, pd.DataFrame(columns=['w_geocode', 'h_geocode', 'Number of Cars']))
+    blocks = _state['blocks'][_state['blocks']['GEOID'].str.startswith(county)]
+    od = join_centroids(lodes, blocks)
+    write_table(od, os.path.join(out_dir, GEOIDS_FILE))
+
+    # ZCTA index of the routing scripts
+    select_study_zctas(_state['zctas'], poly).to_parquet(os.path.join(out_dir, ZCTA_INDEX_FILE), index=False)
+
+    # ACS rows of the ZCTAs intersecting the county
+    zips = zctas_in_county(_state['zctas'], poly)
+    if _state['acs'] is not None:
+        write_table(_state['acs'][_state['acs']['ZCTA5'].isin(zips)], os.path.join(out_dir, "acs.parquet"))
+    pd.DataFrame({"ZCTA5": zips}).to_csv(os.path.join(out_dir, "acs_zctas_used.csv"), index=False)
+
+    # Emission factors, when the county fleet and EMFAC files were prepared
+    fleet_path, emfac_path = FLEET_TEMPLATE.format(county=county), EMFAC_TEMPLATE.format(county=county)
+    if os.path.exists(fleet_path) and os.path.exists(emfac_path):
+        merged_df = merge_fleet_emfac(load_fleet_counts(fleet_path), load_emfac_rates(emfac_path))
+        write_table(average_emissions_per_geoid(merged_df), os.path.join(out_dir, EMISSIONS_FILE))
+        factors = "emission factors written"
+    else:
+        factors = "no fleet/EMFAC files, emission factors skipped"
+    return f"{county}: {len(od)} OD rows, {len(zips)} ZCTAs, {factors}"
+
+
+def main():
+    args = sys.argv[1:]
+    processes = 1
+    if "--processes" in args:
+        k = args.index("--processes")
+        processes = int(args[k + 1])
+        del args[k:k + 2]
+
+    start = time.time()
+    load_statewide()
+    print(f"Statewide data loading time: {time.time() - start:.2f} seconds")
+    counties = args or sorted(_state['counties']['GEOID'])
+
+    if processes > 1:
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            for summary in pool.imap_unordered(process_county, counties):
+                print(summary)
+    else:
+        for county in counties:
+            print(process_county(county))
+    print(f"Processed {len(counties)} counties in {time.time() - start:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# Vectorized distance kernel replacing the per-segment geopy geodesic(a, b).miles loop.
+# A whole route, or a batch of routes packed as flat arrays with offsets, is processed in one NumPy call.
+#
+# Two accuracy modes are available:
+#   'haversine': great circle on a sphere of mean earth radius. Compared to the WGS84 geodesic used by geopy,
+#                the error depends on the direction of the segment. At Santa Clara County latitudes (~37 N) the
+#                sphere is 0.20% too long for north-south segments and 0.23% too short for east-west segments,
+#                so the error on any segment (and on any route, which is a sum of segments) stays within +/-0.25%.
+#   'vincenty':  Vincenty's inverse formula on the WGS84 ellipsoid, iterated until convergence. It agrees with
+#                geopy's geodesic to well under a millimetre for the segment lengths found in routing polylines,
+#                at roughly 5-10x the cost of 'haversine' (still orders of magnitude faster than the Python loop).
+import numpy as np
+
+# Mean earth radius in miles, used by the haversine formula
+EARTH_RADIUS_MILES = 3958.7613
+METERS_PER_MILE = 1609.344
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+
+DISTANCE_MODES = ('haversine', 'vincenty')
+
+
+def haversine_miles(lat1, lon1, lat2, lon2):
+    """Great circle distance in miles between arrays of points given in degrees."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def vincenty_miles(lat1, lon1, lat2, lon2, tol=1e-12, max_iter=200):
+    """
+    Ellipsoidal (WGS84) distance in miles between arrays of points given in degrees, using Vincenty's inverse
+    formula. Coincident points return 0. Nearly antipodal points, which never occur between consecutive route
+    vertices, may not converge and keep the value of the last iteration.
+    """
+    lat1, lon1, lat2, lon2 = (np.asarray(x, dtype=np.float64) for x in (lat1, lon1, lat2, lon2))
+    f = WGS84_F
+    L = np.radians(lon2 - lon1)
+    U1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sin_u1, cos_u1 = np.sin(U1), np.cos(U1)
+    sin_u2, cos_u2 = np.sin(U2), np.cos(U2)
+
+    lam = L
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # Equatorial lines have cos2_alpha = 0, cos_2sigma_m is then set to 0
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)
+            C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C) * f * sin_alpha * (
+                sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2))
+            )
+            if np.all(np.abs(lam - lam_prev) < tol):
+                break
+
+    u2 = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    delta_sigma = B * sin_sigma * (
+        cos_2sigma_m + B / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)
+        )
+    )
+    meters = WGS84_B * A * (sigma - delta_sigma)
+    return meters / METERS_PER_MILE
+
+
+def distance_miles(lat1, lon1, lat2, lon2, mode='haversine'):
+    """Distance in miles between arrays of points, mode is 'haversine' or 'vincenty' (see module notes)."""
+    if mode == 'haversine':
+        return haversine_miles(lat1, lon1, lat2, lon2)
+    if mode == 'vincenty':
+        return vincenty_miles(lat1, lon1, lat2, lon2)
+    raise ValueError(f"mode must be one of {DISTANCE_MODES}, but is `{mode}`")
+
+
+def route_miles(route_coords, mode='haversine'):
+    """
+    Segment lengths in miles of a single route given as a list of (lat, lon) tuples (as returned by
+    polyline.decode). Returns an array with len(route_coords) - 1 entries.
+    """
+    coords = np.asarray(route_coords, dtype=np.float64).reshape(-1, 2)
+    return distance_miles(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1], mode=mode)
+
+
+def segment_index(offsets, n_points):
+    """
+    Index of the first point of every segment of packed routes, skipping the jumps between consecutive routes.
+    The points of route i are points[offsets[i]:offsets[i + 1]].
+    """
+    if n_points < 2:
+        return np.empty(0, dtype=np.int64)
+    valid = np.ones(n_points - 1, dtype=bool)
+    # Segment j joins point j and point j + 1, it is dropped when point j + 1 is the first point of the next route
+    boundaries = np.asarray(offsets[1:-1]) - 1
+    valid[boundaries[(boundaries >= 0) & (boundaries < n_points - 1)]] = False
+    return np.flatnonzero(valid)
+
+
+def batch_route_miles(lat, lon, offsets, mode='haversine'):
+    """
+    Segment lengths in miles of a batch of packed routes.
+    Returns (start, miles) where start is the index of the first point of each segment.
+    """
+    start = segment_index(offsets, len(lat))
+    end = start + 1
+    return start, distance_miles(lat[start], lon[start], lat[end], lon[end], mode=mode)
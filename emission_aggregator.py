@@ -0,0 +1,100 @@
+# Incremental aggregation of the A/B/C/D emission outputs.
+# Instead of one record per (OD row, receptor ZIP) for each output, emissions are accumulated directly into dense
+# arrays indexed by integer ZIP codes (A: receptor, B: origin, C: destination) and into sparse origin x receptor
+# matrices (D, one per pollutant), batch by batch. Memory only depends on the number of ZIPs, not on the number of
+# routes, and the final tables are the same as the groupby sums of the record lists.
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from emission_factors import POLLUTANTS
+
+
+class EmissionAggregator:
+    """
+    Accumulates emissions of OD rows into the A/B/C/D outputs.
+
+    Args:
+        receptor_codes: ZCTA code of every column of the miles matrices passed to add().
+        zip_codes: every origin/destination ZIP that can appear (e.g. the h_zcta and w_zcta values of the OD table).
+    """
+
+    def __init__(self, receptor_codes, zip_codes):
+        self.receptor_codes = np.asarray(receptor_codes)
+        self.zip_codes = pd.Index(pd.unique(pd.Series(zip_codes).dropna()))
+        n_receptor, n_zip, n_poll = len(self.receptor_codes), len(self.zip_codes), len(POLLUTANTS)
+
+        self.receptor = np.zeros((n_receptor, n_poll))
+        self.origin = np.zeros((n_zip, n_poll))
+        self.dest = np.zeros((n_zip, n_poll))
+        self.matrix = [sparse.csr_matrix((n_zip, n_receptor)) for _ in POLLUTANTS]
+        # Number of (OD row, receptor) entries behind every output row, to keep rows whose emissions sum to zero
+        self._receptor_hits = np.zeros(n_receptor, dtype=np.int64)
+        self._origin_hits = np.zeros(n_zip, dtype=np.int64)
+        self._dest_hits = np.zeros(n_zip, dtype=np.int64)
+        self._matrix_hits = sparse.csr_matrix((n_zip, n_receptor), dtype=np.int64)
+
+    def add(self, origin_zip, dest_zip, miles, factors):
+        """
+        Add a batch of OD rows.
+
+        origin_zip, dest_zip: origin/destination ZIP of every row, rows missing either are skipped.
+        miles: sparse (n_rows x n_receptor) vehicle miles of every row in every receptor ZCTA.
+        factors: (n_rows x n_pollutants) per-mile emission factors of every row.
+        """
+        origin = self.zip_codes.get_indexer(pd.Series(origin_zip, dtype=object))
+        dest = self.zip_codes.get_indexer(pd.Series(dest_zip, dtype=object))
+        keep = np.flatnonzero((origin >= 0) & (dest >= 0))
+        if not len(keep):
+            return
+        miles = sparse.csr_matrix(miles)[keep]
+        factors = np.asarray(factors, dtype=float)[keep]
+        origin, dest = origin[keep], dest[keep]
+
+        hits = miles.copy()
+        hits.data = np.ones_like(hits.data, dtype=np.int64)
+        row_hits = np.diff(hits.indptr)
+        row_emissions = np.asarray(miles.sum(axis=1)).ravel()[:, None] * factors
+
+        self.receptor += miles.T @ factors
+        self._receptor_hits += np.asarray(hits.sum(axis=0)).ravel()
+        np.add.at(self.origin, origin, row_emissions)
+        np.add.at(self.dest, dest, row_emissions)
+        np.add.at(self._origin_hits, origin, row_hits)
+        np.add.at(self._dest_hits, dest, row_hits)
+
+        # Indicator matrix summing the rows of the batch into their origin ZIP
+        to_origin = sparse.csr_matrix(
+            (np.ones(len(keep)), (origin, np.arange(len(keep)))), shape=(len(self.zip_codes), len(keep))
+        )
+        for p in range(len(POLLUTANTS)):
+            self.matrix[p] = self.matrix[p] + to_origin @ sparse.diags(factors[:, p]) @ miles
+        self._matrix_hits = self._matrix_hits + (to_origin @ hits).astype(np.int64)
+
+    def _dense_table(self, key, codes, values, hits):
+        table = pd.DataFrame(values[hits > 0], columns=POLLUTANTS)
+        table.insert(0, key, codes[hits > 0])
+        return table.sort_values(key, ignore_index=True)
+
+    def receptor_table(self):
+        """A: total emissions per receptor ZIP."""
+        return self._dense_table('zip', self.receptor_codes, self.receptor, self._receptor_hits)
+
+    def origin_table(self):
+        """B: emissions caused by each origin ZIP."""
+        return self._dense_table('origin_zip', np.asarray(self.zip_codes), self.origin, self._origin_hits)
+
+    def destination_table(self):
+        """C: emissions caused by each destination ZIP."""
+        return self._dense_table('dest_zip', np.asarray(self.zip_codes), self.dest, self._dest_hits)
+
+    def matrix_table(self):
+        """D: origin ZIP -> receptor ZIP emissions."""
+        hits = self._matrix_hits.tocoo()
+        table = pd.DataFrame({
+            'origin_zip': np.asarray(self.zip_codes)[hits.row],
+            'receptor_zip': self.receptor_codes[hits.col],
+        })
+        for p, pollutant in enumerate(POLLUTANTS):
+            table[pollutant] = np.asarray(self.matrix[p].tocsr()[hits.row, hits.col]).ravel()
+        return table.sort_values(['origin_zip', 'receptor_zip'], ignore_index=True)
@@ -0,0 +1,35 @@
+# Helpers to attach the per-mile emission factors of emissions_toymodel_SantaClara.py to the OD table.
+# The factors are joined once on the 12-digit block group code of the home block, instead of filtering
+# emissions_df for every route, and OD rows without factors are reported together before routing starts.
+import pandas as pd
+
+POLLUTANTS = ['PM25', 'SOx', 'NOX', 'VOC', 'NH3', 'CO2']
+FACTOR_COLS = [f'{p}_per_mile' for p in POLLUTANTS]
+BLOCK_GROUP_COL = 'Census Block Group Code'
+
+
+def join_emission_factors(od_df: pd.DataFrame, emissions_df: pd.DataFrame):
+    """
+    Add the block group code (first 12 digits of h_geocode) and its per-mile emission factors to every OD row.
+    Returns (joined, missing) where missing holds the OD rows whose block group has no emission factors;
+    they are left out of joined.
+    """
+    od_df = od_df.copy()
+    od_df['block_group'] = od_df['h_geocode'].astype(str).str[:12]
+
+    factors = emissions_df[[BLOCK_GROUP_COL] + FACTOR_COLS].drop_duplicates(subset=BLOCK_GROUP_COL)
+    factors = factors.rename(columns={BLOCK_GROUP_COL: 'block_group'})
+    joined = od_df.merge(factors, on='block_group', how='left', validate='many_to_one')
+    # the merge resets the index, keep the original OD row number as route index
+    joined.index = od_df.index
+
+    has_factors = joined[FACTOR_COLS].notna().all(axis=1)
+    return joined[has_factors], joined[~has_factors]
+
+
+def report_missing_factors(missing: pd.DataFrame):
+    """Print one summary line for all OD rows without emission factors."""
+    if missing.empty:
+        return
+    codes = sorted(missing['block_group'].unique())
+    print(f"[!] No emissions data for {len(codes)} GEOIDs ({len(missing)} OD rows skipped): {', '.join(codes)}")
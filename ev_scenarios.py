@@ -0,0 +1,179 @@
+# Batch EV-adoption scenario engine on top of emissions_toymodel_SantaClara.py.
+# The fleet and EMFAC tables are read and merged once; a whole table of fleet perturbations (EV penetration by block
+# group, model year retirement, fuel shifts) is then evaluated as array operations over the merged fleet x EMFAC
+# rows, giving a scenario-indexed array of per-block-group per-mile factors. The array plugs directly into
+# vmt_tensor.evaluate_scenarios to get ZIP-level emissions for every scenario.
+#
+# Usage:
+#   python ev_scenarios.py scenarios.csv [output.npz]
+#
+# scenarios.csv has one row per perturbation, several rows may belong to the same scenario:
+#   scenario:                 scenario name
+#   Census Block Group Code:  optional, restricts the perturbation to one block group (empty = whole county)
+#   fuel_from, fuel_to, shift: optional, moves this fraction of the fuel_from vehicles to fuel_to, keeping their
+#                             vehicle category and model year (e.g. Gasoline -> Electricity, 0.3)
+#   retire_before:            optional, vehicles with a model year before this value are removed from the fleet
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from emissions_toymodel_SantaClara import FLEET_PATH, EMFAC_PATH, POLLUTANTS, load_fleet_counts, load_emfac_rates, merge_fleet_emfac
+
+BLOCK_GROUP_COL = 'Census Block Group Code'
+RATE_KEYS = ['Vehicle Category', 'Model Year', 'Fuel']
+
+
+class ScenarioEngine:
+    """
+    Evaluates fleet perturbations over the merged fleet x EMFAC table.
+
+    Args:
+        merged_df: output of emissions_toymodel_SantaClara.merge_fleet_emfac.
+        EMFAC_new: per-mile rates of emissions_toymodel_SantaClara.load_emfac_rates, used to look up the rates of
+            the fuel vehicles are shifted to.
+    """
+
+    def __init__(self, merged_df, EMFAC_new):
+        codes = merged_df[BLOCK_GROUP_COL].astype(str).str.zfill(12)
+        bg_index, self.bg_codes = pd.factorize(codes, sort=True)
+        self.bg_codes = np.asarray(self.bg_codes)
+        n_rows = len(merged_df)
+
+        self.rows = pd.DataFrame({'bg': codes.to_numpy(), 'Fuel': merged_df['Fuel'].to_numpy(), 'row': np.arange(n_rows)})
+        self.count = merged_df['vehicle_count'].to_numpy(dtype=float)
+        self.model_year = merged_df['Model Year'].to_numpy(dtype=float)
+        # Rows without EMFAC match keep their weight but contribute no emissions, as in average_emissions_per_geoid
+        self.factors = np.nan_to_num(merged_df[POLLUTANTS].to_numpy(dtype=float))
+        # Indicator matrix summing fleet rows into their block group
+        self.groups = sparse.csr_matrix(
+            (np.ones(n_rows), (bg_index, np.arange(n_rows))), shape=(len(self.bg_codes), n_rows)
+        )
+
+        self._category = merged_df['Vehicle Category'].to_numpy()
+        self._rates = EMFAC_new.drop_duplicates(subset=RATE_KEYS).set_index(RATE_KEYS)[POLLUTANTS]
+        self._target_rates = {}
+
+    @classmethod
+    def from_files(cls, fleet_path=FLEET_PATH, emfac_path=EMFAC_PATH):
+        """Read and merge the fleet and EMFAC tables once."""
+        fleet_counts = load_fleet_counts(fleet_path)
+        EMFAC_new = load_emfac_rates(emfac_path)
+        return cls(merge_fleet_emfac(fleet_counts, EMFAC_new), EMFAC_new)
+
+    def target_rates(self, fuel):
+        """EMFAC rates of `fuel` for the vehicle category and model year of every fleet row (NaN where EMFAC has none)."""
+        if fuel not in self._target_rates:
+            keys = pd.MultiIndex.from_arrays(
+                [self._category, self.model_year.astype(int), np.full(len(self.count), fuel)], names=RATE_KEYS
+            )
+            self._target_rates[fuel] = self._rates.reindex(keys).to_numpy(dtype=float)
+        return self._target_rates[fuel]
+
+    def _row_pairs(self, perturbations, fuel_col=None):
+        """
+        (perturbation, fleet row) pairs affected by each perturbation, found with merges rather than row loops.
+        Perturbations with a block group only reach the rows of that block group, and with fuel_col only the rows
+        whose fuel is the value of that column.
+        """
+        everywhere = perturbations[perturbations[BLOCK_GROUP_COL].isna()]
+        local = perturbations[perturbations[BLOCK_GROUP_COL].notna()]
+        left, right = ([fuel_col], ['Fuel']) if fuel_col else ([], [])
+        pairs = [
+            everywhere.merge(self.rows, left_on=left, right_on=right) if left else everywhere.merge(self.rows, how='cross'),
+            local.merge(self.rows, left_on=[BLOCK_GROUP_COL] + left, right_on=['bg'] + right),
+        ]
+        return pd.concat(pairs, ignore_index=True)
+
+    def evaluate(self, scenarios, chunk_size=50):
+        """
+        Evaluate a table of perturbations (see module notes for the columns).
+        Returns (scenario_names, block_group_codes, factors) with factors of shape
+        (n_scenarios, n_block_groups, n_pollutants), the same layout as vmt_tensor.factor_array.
+        Scenarios are processed in chunks of chunk_size to bound memory.
+        """
+        scenarios = scenarios.copy()
+        for col, default in ((BLOCK_GROUP_COL, np.nan), ('fuel_from', np.nan), ('fuel_to', np.nan),
+                             ('shift', 0.0), ('retire_before', np.nan)):
+            if col not in scenarios.columns:
+                scenarios[col] = default
+        scenarios[BLOCK_GROUP_COL] = scenarios[BLOCK_GROUP_COL].where(
+            scenarios[BLOCK_GROUP_COL].isna(),
+            scenarios[BLOCK_GROUP_COL].astype(str).str.split('.').str[0].str.zfill(12),
+        )
+        names = pd.unique(scenarios['scenario'])
+        scenarios['s'] = pd.Index(names).get_indexer(scenarios['scenario'])
+
+        out = np.empty((len(names), len(self.bg_codes), len(POLLUTANTS)))
+        for start in range(0, len(names), chunk_size):
+            chunk = scenarios[(scenarios['s'] >= start) & (scenarios['s'] < start + chunk_size)].copy()
+            chunk['s'] -= start
+            n_chunk = min(chunk_size, len(names) - start)
+            out[start:start + n_chunk] = self._evaluate_chunk(chunk, n_chunk)
+        return list(names), self.bg_codes, out
+
+    def _evaluate_chunk(self, scenarios, n_scenarios):
+        n_rows = len(self.count)
+
+        # Retirement: vehicles older than the latest retire_before reaching their row in the scenario are removed
+        retire = np.full((n_scenarios, n_rows), -np.inf)
+        pairs = self._row_pairs(scenarios[scenarios['retire_before'].notna()])
+        if len(pairs):
+            np.maximum.at(retire, (pairs['s'].to_numpy(), pairs['row'].to_numpy()), pairs['retire_before'].to_numpy(dtype=float))
+        weights = self.count[None, :] * (self.model_year[None, :] >= retire)
+
+        # Fuel shifts: shifted[s, t, r] is the fraction of fleet row r moved to target fuel t in scenario s
+        shifts = scenarios[scenarios['fuel_to'].notna() & (scenarios['shift'] > 0)]
+        targets = list(pd.unique(shifts['fuel_to']))
+        target_rates = np.stack([self.target_rates(f) for f in targets]) if targets else np.empty((0, n_rows, len(POLLUTANTS)))
+        shifted = np.zeros((n_scenarios, len(targets), n_rows))
+        pairs = self._row_pairs(shifts, fuel_col='fuel_from')
+        if len(pairs):
+            t_idx = pd.Index(targets).get_indexer(pairs['fuel_to'])
+            np.add.at(shifted, (pairs['s'].to_numpy(), t_idx, pairs['row'].to_numpy()), pairs['shift'].to_numpy(dtype=float))
+        # Vehicles are only shifted where EMFAC has rates for the target fuel, and never more than the whole row
+        shifted *= ~np.isnan(target_rates).any(axis=2)[None, :, :]
+        total_shift = shifted.sum(axis=1)
+        shifted *= np.where(total_shift > 1, 1 / np.maximum(total_shift, 1e-12), 1.0)[:, None, :]
+        kept = 1 - np.minimum(total_shift, 1.0)
+
+        # Per-row factors of every scenario, then vehicle-weighted average per block group
+        rates = kept[:, :, None] * self.factors[None, :, :] + np.einsum('stn,tnp->snp', shifted, np.nan_to_num(target_rates))
+        weighted = weights[:, :, None] * rates
+        n_pollutants = len(POLLUTANTS)
+        num = self.groups @ weighted.transpose(1, 0, 2).reshape(n_rows, n_scenarios * n_pollutants)
+        den = self.groups @ weights.T
+        num = np.asarray(num).reshape(len(self.bg_codes), n_scenarios, n_pollutants)
+        den = np.asarray(den)[:, :, None]
+        avg = np.divide(num, den, out=np.zeros_like(num), where=den > 0)
+        return avg.transpose(1, 0, 2)
+
+
+def to_tables(names, block_group_codes, factors):
+    """Scenario name -> DataFrame in the format of avg_emissions_per_geoid_SantaClara.csv."""
+    cols = [f'{p}_per_mile' for p in POLLUTANTS]
+    tables = {}
+    for s, name in enumerate(names):
+        table = pd.DataFrame(factors[s], columns=cols)
+        table.insert(0, BLOCK_GROUP_COL, block_group_codes)
+        tables[name] = table
+    return tables
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python ev_scenarios.py <scenarios.csv> [output.npz]")
+        sys.exit(1)
+    out_path = sys.argv[2] if len(sys.argv) > 2 else "data/ev_scenario_factors.npz"
+
+    engine = ScenarioEngine.from_files()
+    scenarios = pd.read_csv(sys.argv[1], dtype={BLOCK_GROUP_COL: str})
+    names, codes, factors = engine.evaluate(scenarios)
+    np.savez(out_path, scenarios=np.asarray(names, dtype=str), block_groups=codes.astype(str),
+             pollutants=np.asarray(POLLUTANTS), factors=factors)
+    print(f"Saved {len(names)} scenarios x {len(codes)} block groups to {out_path}")
+
+
+if __name__ == "__main__":
+    main()
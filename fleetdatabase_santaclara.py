@@ -1,7 +1,11 @@
 #This script will serve to treat the fleet dataset for the county of santa clara in order to begin our toy model
 #This will allow for the fuel collumn to be generated so that this can be crossed with the summed EMFAC dataset
+import sys
+
 import pandas as pd
 
+from interchange import write_table
+
 # Path to fleet database file
 file_path = "data/FleetDB-County-SANTACLARA-2023-P_T1_T2-GVWR-All-All-Agg-All-Agg-ByCensusBlockGroupCode.csv"
 
@@ -34,7 +38,7 @@ def classify_fuel(row):
 # Create fuel collumn
 df['fuel'] = df.apply(classify_fuel, axis=1)
 
-# Save result
-df.to_csv("data/cleaned_fleet_data.csv", index=False)
+# Save result, as Parquet with a typed block group code (and as CSV too with --csv)
+write_table(df, "data/cleaned_fleet_data.parquet", export_csv='--csv' in sys.argv[1:])
 
-print("Cleaned data saved as 'cleaned_fleet_data.csv'")
\ No newline at end of file
+print("Cleaned data saved as 'cleaned_fleet_data.parquet'")
\ No newline at end of file
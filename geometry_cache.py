@@ -0,0 +1,118 @@
+# Cache of reprojected TIGER layers.
+# Reading a TIGER shapefile and reprojecting it to EPSG:4326 dominates the startup of short runs. Each layer is read
+# once (restricted to the selected state/county/bbox), reprojected and stored as uncompressed Feather with WKB
+# geometries in data/geometry_cache/, which later runs memory-map instead of parsing the shapefile again.
+# The cache key is the hash of the source files (shapefile and sidecars) plus the selection, so a new TIGER
+# download or another county gets its own entry.
+#
+# Usage (one-time preparation of the layers read by the preprocessing scripts for a county):
+#   python geometry_cache.py [county GEOID]
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+import geopandas as gpd
+
+CACHE_DIR = "data/geometry_cache"
+SOURCE_HASHES = "source_hashes.json" # memoized source hashes, by file size and modification time
+_SIDECARS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _temp_path(path):
+    """Temporary file of this process next to path, renamed over it once written (concurrent runs never share it)."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    os.close(fd)
+    return tmp
+
+
+def _read_memo(memo_path):
+    """Memoized source hashes, empty when the memo is missing or was not fully written."""
+    try:
+        with open(memo_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def source_hash(path, cache_dir=CACHE_DIR):
+    """SHA-256 over the source file and its shapefile sidecars, only re-hashed when a file size or mtime changes."""
+    stem = os.path.splitext(path)[0]
+    files = [stem + ext for ext in _SIDECARS if os.path.exists(stem + ext)] or [path]
+
+    memo_path = os.path.join(cache_dir, SOURCE_HASHES)
+    memo = _read_memo(memo_path)
+
+    digest = hashlib.sha256()
+    changed = False
+    for file in files:
+        stat = os.stat(file)
+        stamp = f"{stat.st_size}-{stat.st_mtime_ns}"
+        entry = memo.get(os.path.abspath(file))
+        if entry is None or entry['stamp'] != stamp:
+            entry = {'stamp': stamp, 'sha256': _file_sha256(file)}
+            memo[os.path.abspath(file)] = entry
+            changed = True
+        digest.update(entry['sha256'].encode())
+
+    if changed:
+        # Concurrent runs (e.g. array tasks) may each write the memo, the last rename wins and an entry lost that
+        # way is only hashed again
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = _temp_path(memo_path)
+        with open(tmp, "w") as f:
+            json.dump(memo, f, indent=1)
+        os.replace(tmp, memo_path)
+    return digest.hexdigest()
+
+
+def read_layer(path, name, where=None, bbox=None, cache_dir=CACHE_DIR) -> gpd.GeoDataFrame:
+    """
+    gpd.read_file(path, where=where, bbox=bbox) reprojected to EPSG:4326, through the cache.
+    name: prefix of the cache file, e.g. 'blocks'.
+    """
+    selection = [where, None if bbox is None else [round(float(v), 6) for v in bbox]]
+    key = hashlib.sha256(json.dumps([source_hash(path, cache_dir), selection]).encode()).hexdigest()[:16]
+    cached = os.path.join(cache_dir, f"{name}-{key}.feather")
+    if os.path.exists(cached):
+        return gpd.read_feather(cached, memory_map=True)
+
+    kwargs = {}
+    if where is not None:
+        kwargs['where'] = where
+    if bbox is not None:
+        kwargs['bbox'] = tuple(float(v) for v in bbox)
+    gdf = gpd.read_file(path, **kwargs).to_crs(epsg=4326)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = _temp_path(cached)
+    gdf.to_feather(tmp, compression="uncompressed")
+    os.replace(tmp, cached)
+    return gdf
+
+
+def main():
+    # Same reads as GEOIDtocoord.py, zcta_index.py and Census_ZIPcode_filtering.py, so their cache entries exist
+    from Census_ZIPcode_filtering import COUNTIES_SHP, ZCTA_SHP, load_sc_polygon, load_zctas
+    from GEOIDtocoord import COUNTY, load_block_centroids, assign_zctas
+    from zcta_index import BBOX_BUFFER_DEG, study_bbox
+
+    county = sys.argv[1] if len(sys.argv) > 1 else COUNTY
+    poly = load_sc_polygon(COUNTIES_SHP, county)
+    load_zctas(ZCTA_SHP, bbox=tuple(poly.total_bounds))
+    load_zctas(ZCTA_SHP, bbox=study_bbox(poly, BBOX_BUFFER_DEG))
+    assign_zctas(load_block_centroids(county))
+    print(f"Geometry layers of {county} cached in {CACHE_DIR}")
+
+
+if __name__ == "__main__":
+    main()
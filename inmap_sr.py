@@ -0,0 +1,439 @@
+# Native evaluation of the InMAP source-receptor (SR) matrices, without the srpredict executable.
+# load_inmap.run_sr writes the emissions to a temporary shapefile, runs `inmap srpredict` and reads its output
+# shapefile back on every call. Here the ISRM/APSCA .ncf file is opened lazily (memory-mapped for NetCDF classic
+# files, read on demand through h5py for NetCDF4/HDF5 files), emissions are allocated to the SR grid cells with a
+# sparse matrix, and only the SR rows of the source cells that actually receive emissions are read:
+#   concentration[receptor] = sum over touched sources of emissions[source] * SR[layer, source, receptor]
+#
+# SR file layout (as written by InMAP): one variable per species (PrimaryPM25, pNH4, pSO4, pNO3, SOA) with
+# dimensions (layer, source cell, receptor cell) in (μg/m3)/(μg/s), and the cell edges N, S, E, W in the SR
+# projection. Emissions are treated as ground-level (layer 0), like srpredict does for shapefiles without stack
+# parameters.
+#
+# For scenario runs, the ZCTA -> grid cell area weights are computed once and cached (zcta_allocation), and
+# run_sr_batch evaluates an emissions matrix with one column per scenario: the SR rows are read once for all
+# scenarios and every scenario comes out of the same sparse matrix-matrix products.
+#
+# Usage:
+#   python inmap_sr.py --fixture          checks sr_predict and run_sr_batch against a hand-computed product on the
+#                                         tiny synthetic SR file data/fixtures/sr_fixture.ncf (6 cells, 2 layers)
+#   python inmap_sr.py <model> [n_sources] compares with srpredict on emissions placed on random California cells of a
+#                                         real SR file (needs the file of MODEL_PATHS and the InMAP executable)
+import hashlib
+import json
+import os
+import re
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
+
+# Spatial reference of the InMAP SR grid
+SR_PROJ = "+proj=lcc +lat_1=33.000000 +lat_2=45.000000 +lat_0=40.000000 +lon_0=-97.000000 +x_0=0 +y_0=0 +a=6370997.000000 +b=6370997.000000 +to_meter=1"
+
+MODEL_PATHS = {
+    #"isrm": "/data/isrmv121/isrm_v1.2.1.ncf",
+    "isrm": "/Users/ehenness/Downloads/isrm_v1.2.1.ncf",
+    "apsca_q0": "/data/apsca/apsca_sr_Q0_v1.2.1.ncf",
+    "apsca_q1": "/data/apsca/apsca_sr_Q1_v1.2.1.ncf",
+    "apsca_q2": "/data/apsca/apsca_sr_Q2_v1.2.1.ncf",
+    "apsca_q3": "/data/apsca/apsca_sr_Q3_v1.2.1.ncf",
+    "apsca_q4": "/data/apsca/apsca_sr_Q4_v1.2.1.ncf",
+}
+
+# SR species -> emission column of the srpredict emissions shapefiles
+SPECIES = {
+    'PrimaryPM25': 'PM2_5',
+    'pNH4': 'NH3',
+    'pSO4': 'SOx',
+    'pNO3': 'NOx',
+    'SOA': 'VOC',
+}
+
+# Emission units -> factor to μg/s (same conversions as InMAP, 1 short ton = 907184740000 μg, 1 year = 8760 h)
+EMIS_CONV = {
+    'tons/year': 907184740000.0 / (3600.0 * 8760.0),
+    'kg/year': 1e9 / (3600.0 * 8760.0),
+    'ug/s': 1.0,
+    'μg/s': 1.0,
+}
+
+# Pollutant columns of the emission outputs (emission_factors.POLLUTANTS) -> InMAP emission column
+POLLUTANT_TO_INMAP = {
+    'PM25': 'PM2_5',
+    'NH3': 'NH3',
+    'SOx': 'SOx',
+    'NOX': 'NOx',
+    'VOC': 'VOC',
+}
+
+SR_ROW_BLOCK = 256 # source rows read from the SR file at once
+ALLOCATION_CACHE_DIR = "data/inmap_allocation"
+SR_FIXTURE = "data/fixtures/sr_fixture.ncf"
+FIXTURE_CELL = 1000.0 # edge of the fixture grid cells, in SR_PROJ meters
+FIXTURE_TOLERANCE = 1e-9 # max relative difference accepted by check_fixture
+
+# Functions allowed in output variable expressions
+_EXPRESSION_FUNCS = {'exp': np.exp, 'log': np.log, 'sqrt': np.sqrt, 'abs': np.abs}
+
+
+class SRMatrix:
+    """
+    Lazily opened InMAP SR matrix.
+
+    Args:
+        path: ISRM/APSCA .ncf file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            from scipy.io import netcdf_file
+            self._file = netcdf_file(path, 'r', mmap=True)
+            self._vars = self._file.variables
+        except (TypeError, ValueError):
+            # Not a NetCDF classic file, NetCDF4 files are HDF5
+            import h5py
+            self._file = h5py.File(path, 'r')
+            self._vars = self._file
+        self._cells = None
+
+    @property
+    def cells(self) -> np.ndarray:
+        """Grid cell polygons (shapely array) in SR_PROJ, in SR index order."""
+        if self._cells is None:
+            missing = [v for v in ('N', 'S', 'E', 'W') if v not in self._vars]
+            if missing:
+                raise KeyError(f"{self.path} has no cell edge variables {missing}")
+            n, s, e, w = (np.asarray(self._vars[v][:], dtype=np.float64) for v in ('N', 'S', 'E', 'W'))
+            self._cells = shapely.box(w, s, e, n)
+        return self._cells
+
+    @property
+    def n_cells(self) -> int:
+        return len(self.cells)
+
+    def variable(self, name) -> np.ndarray:
+        """Per-cell variable of the SR file (e.g. TotalPop), read fully (copied out of the memory map)."""
+        return np.array(self._vars[name][:], dtype=np.float64)
+
+    def has_variable(self, name) -> bool:
+        return name in self._vars
+
+    def apply(self, species, layer, sources, weights) -> np.ndarray:
+        """
+        weights.T @ SR[layer, sources, :], reading the SR rows of `sources` in blocks of SR_ROW_BLOCK.
+        sources: sorted source cell indices; weights: (len(sources),) or (len(sources), k) emissions in μg/s.
+        Returns (n_cells,) or (n_cells, k) concentrations.
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        out = np.zeros((self.n_cells,) + weights.shape[1:])
+        var = self._vars[species]
+        for start in range(0, len(sources), SR_ROW_BLOCK):
+            block = np.asarray(sources[start:start + SR_ROW_BLOCK])
+            rows = np.asarray(var[layer, block, :], dtype=np.float64)
+            out += rows.T @ weights[start:start + SR_ROW_BLOCK]
+        return out
+
+    def close(self):
+        if hasattr(self._file, 'variables'):
+            # A memory-mapped netcdf_file only unmaps cleanly once no variable refers to the mapped data
+            self._file.variables.clear()
+        self._vars = None
+        self._file.close()
+
+
+def allocation_matrix(geoms, cells) -> sparse.csr_matrix:
+    """
+    Sparse (n_cells x n_geoms) matrix of the share of every emission geometry falling in every grid cell,
+    as srpredict allocates shapefile emissions: polygons by area, lines by length, points to the containing cell.
+    Geometries and cells must be in the same projection; parts outside the grid are dropped.
+    """
+    geoms = np.asarray(geoms)
+    geom_idx, cell_idx = shapely.STRtree(cells).query(geoms, predicate='intersects')
+    pieces = shapely.intersection(geoms[geom_idx], cells[cell_idx])
+
+    dim = shapely.get_dimensions(geoms)[geom_idx]
+    weights = np.zeros(len(geom_idx))
+    area = dim == 2
+    weights[area] = shapely.area(pieces[area]) / shapely.area(geoms[geom_idx[area]])
+    line = dim == 1
+    weights[line] = shapely.length(pieces[line]) / shapely.length(geoms[geom_idx[line]])
+    # Points on a cell edge intersect several cells, their emissions are split evenly between them
+    point = dim == 0
+    weights[point] = 1.0 / np.bincount(geom_idx[point], minlength=len(geoms))[geom_idx[point]]
+
+    return sparse.csr_matrix((weights, (cell_idx, geom_idx)), shape=(len(cells), len(geoms)))
+
+
+def _species_concentrations(sr, cell_emis, layer):
+    """SR species -> concentrations, from (n_cells, ...) emissions per species in μg/s (sparse rows are skipped)."""
+    conc = {}
+    for species, emis in cell_emis.items():
+        touched = np.flatnonzero(np.abs(emis).reshape(len(emis), -1).sum(axis=1))
+        conc[species] = sr.apply(species, layer, touched, emis[touched])
+    return conc
+
+
+def evaluate_outputs(sr, conc, output_variables) -> dict:
+    """
+    Evaluate srpredict output expressions (e.g. {"TotalPM25": "PrimaryPM25 + pNH4 + pSO4 + pNO3 + SOA"}) over the
+    species concentrations, (n_cells,) or (n_cells, n_scenarios), and the per-cell variables of the SR file they
+    reference. Returns output name -> array shaped like the concentrations.
+    """
+    n_dims = next(iter(conc.values())).ndim
+    cols = dict(conc)
+    for expression in output_variables.values():
+        for name in re.findall(r"[A-Za-z_]\w*", expression):
+            if name not in cols and name not in _EXPRESSION_FUNCS and sr.has_variable(name):
+                values = sr.variable(name)
+                cols[name] = values[:, None] if n_dims == 2 else values
+    namespace = {'__builtins__': {}, **_EXPRESSION_FUNCS}
+    return {out: np.asarray(eval(expression, namespace, cols), dtype=np.float64) for out, expression in output_variables.items()}
+
+
+def sr_predict(emis, sr, output_variables, emis_units="tons/year", layer=0) -> gpd.GeoDataFrame:
+    """
+    In-process equivalent of `inmap srpredict`.
+
+    Args:
+        emis: GeoDataFrame with emission columns VOC, NOx, NH3, SOx, PM2_5 (missing columns count as zero).
+        sr: SRMatrix or path of the SR file.
+        output_variables: output name -> expression, as for load_inmap.run_sr.
+        emis_units: 'tons/year', 'kg/year', 'ug/s' or 'μg/s'.
+        layer: SR layer the emissions are released in (0 = ground level).
+    Returns a GeoDataFrame with one row per grid cell, in SR_PROJ.
+    """
+    sr = SRMatrix(sr) if isinstance(sr, str) else sr
+    emis = emis.to_crs(SR_PROJ)
+    alloc = allocation_matrix(np.asarray(emis.geometry.values), sr.cells)
+
+    cell_emis = {}
+    for species, col in SPECIES.items():
+        values = emis[col].to_numpy(dtype=np.float64) if col in emis.columns else np.zeros(len(emis))
+        cell_emis[species] = alloc @ (values * EMIS_CONV[emis_units])
+    output = evaluate_outputs(sr, _species_concentrations(sr, cell_emis, layer), output_variables)
+    return gpd.GeoDataFrame(pd.DataFrame(output), geometry=sr.cells, crs=SR_PROJ)
+
+
+def zcta_allocation(zcta, sr, cache_dir=ALLOCATION_CACHE_DIR) -> sparse.csr_matrix:
+    """
+    Sparse (n_cells x n_zcta) area weights of every ZCTA polygon in every SR grid cell (see allocation_matrix),
+    cached in cache_dir under a key built from the ZCTA codes and geometries and the SR file.
+
+    zcta: GeoDataFrame with ZCTA5 and polygon geometries (e.g. the zcta_index.py GeoParquet), rows in the order
+        of the emission matrices passed to run_sr_batch.
+    """
+    key = hashlib.sha256()
+    key.update(json.dumps([os.path.abspath(sr.path), os.path.getsize(sr.path), list(map(str, zcta['ZCTA5']))]).encode())
+    key.update(b"".join(shapely.to_wkb(np.asarray(zcta.geometry.values))))
+    path = os.path.join(cache_dir, f"zcta_allocation_{key.hexdigest()[:16]}.npz")
+    if os.path.exists(path):
+        return sparse.load_npz(path).tocsr()
+
+    allocation = allocation_matrix(np.asarray(zcta.to_crs(SR_PROJ).geometry.values), sr.cells)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        sparse.save_npz(f, allocation)
+    os.replace(path + ".tmp", path)
+    return allocation
+
+
+def scenario_emissions(tables, zcta_codes):
+    """
+    Stack per-scenario ZIP emission tables (e.g. vmt_tensor.evaluate_scenarios receptor outputs, with a
+    receptor_zip or zip column and the emission_factors.POLLUTANTS columns) into emission matrices.
+    Returns (scenario_names, {InMAP emission column: (n_zcta, n_scenarios) array}), rows in zcta_codes order.
+    """
+    names = list(tables)
+    codes = pd.Index(zcta_codes)
+    emissions = {col: np.zeros((len(codes), len(names))) for col in POLLUTANT_TO_INMAP.values()}
+    for s, name in enumerate(names):
+        table = tables[name]
+        zip_col = 'receptor_zip' if 'receptor_zip' in table.columns else 'zip'
+        rows = codes.get_indexer(table[zip_col].astype(str))
+        found = rows >= 0
+        for pollutant, col in POLLUTANT_TO_INMAP.items():
+            np.add.at(emissions[col][:, s], rows[found], table[pollutant].to_numpy(dtype=np.float64)[found])
+    return names, emissions
+
+
+def run_sr_batch(emissions, zcta, model, output_variables, emis_units="tons/year", layer=0, cache_dir=ALLOCATION_CACHE_DIR):
+    """
+    Evaluate many emission scenarios over ZCTAs in one pass through the SR matrix.
+
+    Args:
+        emissions: InMAP emission column (VOC, NOx, NH3, SOx, PM2_5) -> (n_zcta, n_scenarios) array, one column per
+            scenario, rows in the order of zcta (see scenario_emissions). Missing columns count as zero.
+        zcta: GeoDataFrame of the ZCTA polygons.
+        model: key of MODEL_PATHS or path of an SR file.
+        output_variables: output name -> expression, as for load_inmap.run_sr.
+    Returns (cells, outputs): the grid cell polygons in SR_PROJ and output name -> (n_cells, n_scenarios) array.
+    """
+    sr = SRMatrix(MODEL_PATHS.get(model, model))
+    try:
+        allocation = zcta_allocation(zcta, sr, cache_dir)
+        n_scenarios = next(iter(emissions.values())).shape[1]
+
+        cell_emis = {}
+        for species, col in SPECIES.items():
+            values = emissions.get(col, np.zeros((len(zcta), n_scenarios)))
+            cell_emis[species] = np.asarray(allocation @ (np.asarray(values, dtype=np.float64) * EMIS_CONV[emis_units]))
+        outputs = evaluate_outputs(sr, _species_concentrations(sr, cell_emis, layer), output_variables)
+        return sr.cells, outputs
+    finally:
+        sr.close()
+
+
+def fixture_emissions(sr, n_sources=5, seed=0, bbox=(-124.5, 32.5, -114.1, 42.0)) -> gpd.GeoDataFrame:
+    """A few small emission polygons inside random grid cells of bbox (lon/lat), for validation runs."""
+    rng = np.random.default_rng(seed)
+    centroids = gpd.GeoSeries(shapely.centroid(sr.cells), crs=SR_PROJ).to_crs(epsg=4326)
+    candidates = centroids.cx[bbox[0]:bbox[2], bbox[1]:bbox[3]].index.to_numpy()
+    picked = rng.choice(candidates, n_sources, replace=False)
+    # Shrunk copies of the cells, so each source falls in a single cell
+    cells = sr.cells[picked]
+    size = np.sqrt(shapely.area(cells))
+    geoms = shapely.buffer(cells, -0.25 * size, join_style='mitre')
+    data = {col: rng.uniform(1, 100, n_sources) for col in SPECIES.values()}
+    return gpd.GeoDataFrame(data, geometry=geoms, crs=SR_PROJ)
+
+
+def write_sr_fixture(path=SR_FIXTURE, seed=0):
+    """
+    Write a tiny SR file in the layout read by SRMatrix: a 3 x 2 grid of FIXTURE_CELL cells near Santa Clara
+    (cells 0-2 in the bottom row, 3-5 in the top row), 2 layers, random float32 SR values and a TotalPop variable.
+    """
+    from scipy.io import netcdf_file
+
+    rng = np.random.default_rng(seed)
+    col, row = np.arange(6) % 3, np.arange(6) // 3
+    x0, y0 = -2_200_000.0, -250_000.0
+    edges = {
+        'W': x0 + col * FIXTURE_CELL, 'E': x0 + (col + 1) * FIXTURE_CELL,
+        'S': y0 + row * FIXTURE_CELL, 'N': y0 + (row + 1) * FIXTURE_CELL,
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with netcdf_file(path, 'w') as f:
+        f.createDimension('layer', 2)
+        f.createDimension('source', 6)
+        f.createDimension('receptor', 6)
+        f.createDimension('allcells', 6)
+        for name, values in edges.items():
+            f.createVariable(name, 'f8', ('allcells',))[:] = values
+        f.createVariable('TotalPop', 'f8', ('allcells',))[:] = rng.uniform(100, 1000, 6).round()
+        for species in SPECIES:
+            f.createVariable(species, 'f4', ('layer', 'source', 'receptor'))[:] = rng.uniform(1e-9, 1e-7, (2, 6, 6))
+
+
+def _fixture_shapes():
+    """
+    Emission geometries on the fixture grid with known cell shares (cell -> share):
+    a square half in cell 0 and half in cell 1, a line from the center of cell 3 to the center of cell 4
+    (half in each), a point at the center of cell 5, and a square covering cells 2 and 5 (half in each).
+    """
+    x0, y0, c = -2_200_000.0, -250_000.0, FIXTURE_CELL
+    geoms = [
+        shapely.box(x0 + 0.5 * c, y0 + 0.25 * c, x0 + 1.5 * c, y0 + 0.75 * c),
+        shapely.LineString([(x0 + 0.5 * c, y0 + 1.5 * c), (x0 + 1.5 * c, y0 + 1.5 * c)]),
+        shapely.Point(x0 + 2.5 * c, y0 + 1.5 * c),
+        shapely.box(x0 + 2 * c, y0, x0 + 3 * c, y0 + 2 * c),
+    ]
+    shares = np.zeros((6, len(geoms)))
+    shares[[0, 1], 0] = 0.5
+    shares[[3, 4], 1] = 0.5
+    shares[5, 2] = 1.0
+    shares[[2, 5], 3] = 0.5
+    return geoms, shares
+
+
+def check_fixture(path=SR_FIXTURE, cache_dir=None):
+    """
+    Compare sr_predict (both layers) and run_sr_batch on the fixture SR file with the product
+    SR[layer].T @ (shares @ emissions) computed from the hand-made cell shares of _fixture_shapes.
+    Returns check name -> max difference relative to the largest expected value.
+    """
+    import tempfile
+
+    sr = SRMatrix(path)
+    geoms, shares = _fixture_shapes()
+    rng = np.random.default_rng(1)
+    values = {col: rng.uniform(1, 100, len(geoms)) for col in SPECIES.values()}
+    output_variables = {
+        "TotalPM25": "PrimaryPM25 + pNH4 + pSO4 + pNO3 + SOA",
+        "PopWeightedPM25": "TotalPop * PrimaryPM25",
+    }
+    pop = sr.variable('TotalPop')
+    sr_layers = {species: np.array(sr._vars[species][:], dtype=np.float64) for species in SPECIES}
+
+    def expected(layer, cell_shares, emissions):
+        conc = {
+            species: sr_layers[species][layer].T @ (cell_shares @ emissions[col] * EMIS_CONV['tons/year'])
+            for species, col in SPECIES.items()
+        }
+        cell_pop = pop.reshape((-1,) + (1,) * (conc['PrimaryPM25'].ndim - 1))
+        return {"TotalPM25": sum(conc.values()), "PopWeightedPM25": cell_pop * conc['PrimaryPM25']}
+
+    def max_diff(got, want):
+        return max(float(np.abs(got[out] - want[out]).max() / np.abs(want[out]).max()) for out in want)
+
+    diffs = {}
+    emis = gpd.GeoDataFrame(values, geometry=geoms, crs=SR_PROJ)
+    for layer in (0, 1):
+        native = sr_predict(emis, sr, output_variables, layer=layer)
+        got = {out: native[out].to_numpy() for out in output_variables}
+        diffs[f"sr_predict layer {layer}"] = max_diff(got, expected(layer, shares, values))
+
+    # Two scenarios over the two polygon "ZCTAs" (first and last fixture shapes)
+    polygons = [0, 3]
+    zcta = gpd.GeoDataFrame({'ZCTA5': ['00001', '00002']}, geometry=[geoms[i] for i in polygons], crs=SR_PROJ)
+    emissions = {col: np.column_stack([v[polygons], 2 * v[polygons][::-1]]) for col, v in values.items()}
+    with tempfile.TemporaryDirectory() as tmp:
+        _, outputs = run_sr_batch(emissions, zcta, path, output_variables, cache_dir=cache_dir or tmp)
+    want = expected(0, shares[:, polygons], emissions)
+    diffs["run_sr_batch"] = max_diff(outputs, want)
+    sr.close()
+    return diffs
+
+
+def compare_with_srpredict(emis, model, output_variables, emis_units="tons/year"):
+    """Run the emissions through srpredict (load_inmap.run_sr) and sr_predict. Returns the max relative difference per output."""
+    import load_inmap # downloads the InMAP executable
+
+    reference = load_inmap.run_sr(emis, model, output_variables, emis_units=emis_units)
+    native = sr_predict(emis, MODEL_PATHS[model], output_variables, emis_units=emis_units)
+    if len(reference) != len(native):
+        raise ValueError(f"srpredict returned {len(reference)} cells, the SR matrix has {len(native)}")
+    diffs = {}
+    for out in output_variables:
+        ref = reference[out].to_numpy(dtype=np.float64)
+        scale = np.abs(ref).max() or 1.0
+        diffs[out] = float(np.abs(native[out].to_numpy() - ref).max() / scale)
+    return diffs
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python inmap_sr.py --fixture | <model> [n_sources]")
+        sys.exit(1)
+    if sys.argv[1] == "--fixture":
+        if not os.path.exists(SR_FIXTURE):
+            write_sr_fixture()
+        diffs = check_fixture()
+        for check, diff in diffs.items():
+            print(f"{check}: max difference {diff:.2e} of the expected maximum")
+        sys.exit(0 if max(diffs.values()) <= FIXTURE_TOLERANCE else 1)
+    model = sys.argv[1]
+    n_sources = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    output_variables = {"TotalPM25": "PrimaryPM25 + pNH4 + pSO4 + pNO3 + SOA"}
+    emis = fixture_emissions(SRMatrix(MODEL_PATHS[model]), n_sources)
+    for out, diff in compare_with_srpredict(emis, model, output_variables).items():
+        print(f"{out}: max difference {diff:.2e} of the srpredict maximum")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Interchange format of the preprocessing chain.
+# Stages hand their tables to each other as Parquet files with typed GEOID columns (fixed-width strings, padded once
+# when the table is written), so readers no longer re-parse CSVs and re-pad GEOIDs with zfill. Readers can prune
+# columns and push filters down to the Parquet row groups (e.g. a county prefix on h_geocode).
+# CSV stays available as an export next to the Parquet file, and as a fallback input when only the CSV exists.
+import os
+
+import pandas as pd
+
+# Width of every GEOID-like column, GEOIDs are stored as zero-padded strings
+GEOID_WIDTHS = {
+    'h_geocode': 15,
+    'w_geocode': 15,
+    'GEOID': 15,
+    'Census Block Group Code': 12,
+    'block_group': 12,
+    'h_zcta': 5,
+    'w_zcta': 5,
+    'ZCTA5': 5,
+}
+
+
+def fixed_width(values: pd.Series, width: int) -> pd.Series:
+    """Zero-padded string codes of width `width`, whether values were read as strings, integers or floats."""
+    if pd.api.types.is_numeric_dtype(values):
+        values = values.astype('Int64')
+    values = values.astype('string').str.zfill(width)
+    return values.astype(object).where(values.notna(), None)
+
+
+def type_geoids(df: pd.DataFrame) -> pd.DataFrame:
+    """Pad every GEOID column of df to its fixed width (see GEOID_WIDTHS)."""
+    df = df.copy()
+    for col, width in GEOID_WIDTHS.items():
+        if col in df.columns:
+            df[col] = fixed_width(df[col], width)
+    return df
+
+
+def csv_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".csv"
+
+
+def write_table(df: pd.DataFrame, path: str, export_csv: bool = False):
+    """Write df as Parquet with typed GEOIDs, and as CSV next to it when export_csv is set."""
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    df = type_geoids(df)
+    df.to_parquet(path, index=False)
+    if export_csv:
+        df.to_csv(csv_path(path), index=False)
+
+
+def prefix_filter(col: str, prefix: str):
+    """Parquet filters keeping the rows whose string column starts with prefix."""
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return [(col, '>=', prefix), (col, '<', upper)]
+
+
+def _apply_filters(df: pd.DataFrame, filters) -> pd.DataFrame:
+    ops = {
+        '==': lambda s, v: s == v, '!=': lambda s, v: s != v,
+        '<': lambda s, v: s < v, '<=': lambda s, v: s <= v,
+        '>': lambda s, v: s > v, '>=': lambda s, v: s >= v,
+        'in': lambda s, v: s.isin(v), 'not in': lambda s, v: ~s.isin(v),
+    }
+    keep = pd.Series(True, index=df.index)
+    for col, op, value in filters:
+        keep &= ops[op](df[col], value).fillna(False).astype(bool)
+    return df[keep]
+
+
+def read_table(path: str, columns=None, filters=None) -> pd.DataFrame:
+    """
+    Read a table written by write_table.
+
+    columns: only read these columns.
+    filters: list of (column, op, value) conditions combined with AND, pushed down to the Parquet reader.
+    Falls back to the CSV with the same name when the Parquet file does not exist (or when path is a .csv),
+    GEOID columns are then padded after reading.
+    """
+    if path.endswith(".parquet") and os.path.exists(path):
+        return pd.read_parquet(path, columns=columns, filters=filters)
+
+    source = csv_path(path)
+    dtype = {col: str for col in GEOID_WIDTHS}
+    usecols = None if columns is None else list(dict.fromkeys([*columns, *(f[0] for f in filters or [])]))
+    df = type_geoids(pd.read_csv(source, usecols=usecols, dtype=dtype))
+    if filters:
+        df = _apply_filters(df, filters)
+    return df if columns is None else df[list(columns)]
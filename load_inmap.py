@@ -9,6 +9,8 @@ import subprocess
 import geopandas as gpd
 import shutil
 
+from inmap_sr import MODEL_PATHS, sr_predict
+
 def _download(url, file_name):
     # open in binary mode
     with open(file_name, "wb") as file:
@@ -43,7 +45,7 @@ if _inmap_exe == None:
 
 ## Load InMAP files -- see https://inmap.run/blog/2019/04/20/sr/ for details
 
-def run_sr(emis, model, output_variables, emis_units="tons/year"):
+def run_sr(emis, model, output_variables, emis_units="tons/year", native=False):
     """
     Run the provided emissions through the specified SR matrix, calculating the
     specified output properties.
@@ -64,26 +66,23 @@ def run_sr(emis, model, output_variables, emis_units="tons/year"):
 
         emis_units: The units that the emissions are in. Allowed values:
             'tons/year', 'kg/year', 'ug/s', and 'μg/s'.
+
+        native: Evaluate the SR matrix in-process with inmap_sr.sr_predict instead
+            of running srpredict through temporary shapefiles.
     """
 
 
     global _tmpdir
     global _inmap_exe
 
-    model_paths = {
-        #"isrm": "/data/isrmv121/isrm_v1.2.1.ncf",
-        "isrm": "/Users/ehenness/Downloads/isrm_v1.2.1.ncf",
-        "apsca_q0": "/data/apsca/apsca_sr_Q0_v1.2.1.ncf",
-        "apsca_q1": "/data/apsca/apsca_sr_Q1_v1.2.1.ncf",
-        "apsca_q2": "/data/apsca/apsca_sr_Q2_v1.2.1.ncf",
-        "apsca_q3": "/data/apsca/apsca_sr_Q3_v1.2.1.ncf",
-        "apsca_q4": "/data/apsca/apsca_sr_Q4_v1.2.1.ncf",
-    }
+    model_paths = MODEL_PATHS
     if model not in model_paths.keys():
         models = ', '.join("{!s}".format(k) for (k) in model_paths.keys())
         msg = 'model must be one of \{{!s}\}, but is `{!s}`'.format(models, model)
         raise ValueError(msg)
     model_path = model_paths[model]
+    if native:
+        return sr_predict(emis, model_path, output_variables, emis_units=emis_units)
 
     start = time.time()
     job_name = "run_aqm_%s"%start
@@ -0,0 +1,103 @@
+# Merges the partial outputs of a sharded run (see sharding.py) into the final A/B/C/D CSVs and VMT tensors.
+# Every output is a sum over OD rows and every OD row belongs to exactly one shard, so the partial tables are
+# concatenated and summed again by their key columns.
+# The route cache files of the shards are merged into the shared route cache, so a later run with any shard count
+# (or unsharded) finds every route already computed.
+#
+# Usage:
+#   python merge_shards.py [output_dir] [--allow-missing]
+import os
+import sys
+
+import pandas as pd
+
+from emission_factors import POLLUTANTS
+from road_class import receptor_class_table
+from route_cache import DEFAULT_CACHE_PATH, RouteCache, shard_cache_paths
+from sharding import COMPLETE_MARKER, list_shard_dirs
+from vmt_tensor import KEY_COLS, load_vmt_tensor, save_vmt_tensor
+
+VMT_FILE = "vmt_attribution.parquet"
+CLASS_VMT_FILE = "vmt_attribution_by_road_class.parquet" # written with --road-classes
+CLASS_VMT_CSV = "receptor_zip_vmt_by_road_class.csv"
+
+# Partial CSV -> key columns, as written by OSRM_SantaClara_cluster.py
+CSV_OUTPUTS = {
+    "receptor_zip_emissions.csv": ['zip'],
+    "origin_zip_emissions.csv": ['origin_zip'],
+    "destination_zip_emissions.csv": ['dest_zip'],
+    "zip_to_zip_emissions_matrix.csv": ['origin_zip', 'receptor_zip'],
+}
+
+
+def merge_csv(shard_dirs, filename, keys):
+    parts = [
+        pd.read_csv(os.path.join(d, filename), dtype={k: str for k in keys})
+        for d in shard_dirs if os.path.exists(os.path.join(d, filename))
+    ]
+    if not parts:
+        return pd.DataFrame()
+    return pd.concat(parts, ignore_index=True).groupby(keys)[POLLUTANTS].sum().reset_index()
+
+
+def merge_vmt(shard_dirs, filename=VMT_FILE, keys=KEY_COLS):
+    parts = [load_vmt_tensor(os.path.join(d, filename)) for d in shard_dirs if os.path.exists(os.path.join(d, filename))]
+    if not parts:
+        return pd.DataFrame()
+    return pd.concat(parts, ignore_index=True).groupby(keys, as_index=False)['miles'].sum()
+
+
+def merge_route_caches(path=DEFAULT_CACHE_PATH):
+    """Merge the route cache files of every shard into the shared cache at path."""
+    shard_caches = shard_cache_paths(path)
+    if not shard_caches:
+        return
+    cache = RouteCache(path)
+    copied = sum(cache.merge(shard_cache) for shard_cache in shard_caches)
+    size = cache.stats()['stored_routes']
+    cache.close()
+    print(f"[✓] {copied} routes of {len(shard_caches)} shard caches merged into {path} ({size} routes)")
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    allow_missing = "--allow-missing" in sys.argv[1:]
+    output_dir = args[0] if args else "emissions_outputs"
+
+    n_shards, found = list_shard_dirs(output_dir)
+    if not n_shards:
+        print(f"No shard directories found in {output_dir}")
+        sys.exit(1)
+    complete = {s: d for s, d in found.items() if os.path.exists(os.path.join(d, COMPLETE_MARKER))}
+    missing = sorted(set(range(n_shards)) - set(complete))
+    if missing:
+        print(f"[!] {len(missing)} of {n_shards} shards are missing or incomplete: {missing}")
+        if not allow_missing:
+            sys.exit(1)
+    shard_dirs = [complete[s] for s in sorted(complete)]
+
+    for filename, keys in CSV_OUTPUTS.items():
+        df = merge_csv(shard_dirs, filename, keys)
+        path = os.path.join(output_dir, filename)
+        if not df.empty:
+            df.to_csv(path, index=False)
+            print(f"[✓] {filename} merged from {len(shard_dirs)} shards to {path} ({len(df)} rows)")
+        else:
+            print(f"[!] Warning: no shard wrote {filename} — no file written.")
+
+    vmt = merge_vmt(shard_dirs)
+    if not vmt.empty:
+        save_vmt_tensor(vmt, os.path.join(output_dir, VMT_FILE))
+        print(f"[✓] VMT attribution tensor merged ({len(vmt)} rows)")
+
+    vmt_by_class = merge_vmt(shard_dirs, CLASS_VMT_FILE, KEY_COLS + ['road_class'])
+    if not vmt_by_class.empty:
+        save_vmt_tensor(vmt_by_class, os.path.join(output_dir, CLASS_VMT_FILE))
+        receptor_class_table(vmt_by_class).to_csv(os.path.join(output_dir, CLASS_VMT_CSV), index=False)
+        print(f"[✓] Road-class VMT tensor merged ({len(vmt_by_class)} rows)")
+
+    merge_route_caches()
+
+
+if __name__ == "__main__":
+    main()
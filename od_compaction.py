@@ -0,0 +1,43 @@
+# Pre-routing compaction of the OD table.
+# LODES has many rows per home/work block pair, and the centroids of small blocks can coincide, so many rows ask
+# for exactly the same route. Rows are collapsed to unique (origin centroid, destination centroid) keys, each key is
+# routed once, and the routed miles are fanned back out to the rows needed for the B/C/D attributions.
+import pandas as pd
+
+from route_cache import DEFAULT_PRECISION
+
+COORD_COLS = ['home_lat', 'home_lon', 'work_lat', 'work_lon']
+CARS_COL = 'Number of Cars'
+
+
+def compact_od(od_df: pd.DataFrame, attribution_cols=('block_group', 'h_zcta', 'w_zcta'), precision: int = DEFAULT_PRECISION):
+    """
+    Collapse OD rows to unique routing keys. Coordinates are rounded like the route cache keys.
+
+    Returns (routes, fanout):
+        routes: one row per unique route, indexed by route_key, with the centroid coordinates,
+            the summed number of cars and the number of OD rows (n_rows) using the route.
+        fanout: OD rows collapsed by (route_key, *attribution_cols), with summed number of cars and n_rows.
+            The other columns (e.g. the emission factors of the block group) keep their first value.
+    """
+    od = od_df.copy()
+    rounded = od[COORD_COLS].round(precision)
+    od['route_key'] = rounded.groupby(COORD_COLS, sort=False, dropna=False).ngroup()
+    od['n_rows'] = 1
+
+    routes = od.groupby('route_key').agg(
+        **{col: (col, 'first') for col in COORD_COLS},
+        **{CARS_COL: (CARS_COL, 'sum'), 'n_rows': ('n_rows', 'sum')},
+    )
+
+    group_cols = ['route_key', *attribution_cols]
+    summed = {CARS_COL: 'sum', 'n_rows': 'sum'}
+    firsts = {col: 'first' for col in od.columns if col not in group_cols and col not in summed}
+    fanout = od.groupby(group_cols, sort=False, dropna=False).agg({**summed, **firsts}).reset_index()
+    return routes, fanout
+
+
+def report_compaction(n_od_rows: int, routes: pd.DataFrame):
+    """Print how many routing calls the compaction saves."""
+    ratio = n_od_rows / len(routes) if len(routes) else 0.0
+    print(f"Compacted {n_od_rows} OD rows into {len(routes)} unique routes (compaction ratio {ratio:.2f}x)")
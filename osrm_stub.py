@@ -0,0 +1,117 @@
+# Offline test double of the local OSRM server, to benchmark routing throughput without a routing graph.
+# It answers /route/v1/driving/{lon},{lat};{lon},{lat} like OSRM (code/routes/geometry as an encoded polyline),
+# returning a straight line broken into a few vertices, with optional artificial latency and random 503 failures
+# to exercise the retry logic of routing_client.OSRMClient.
+#
+# Usage:
+#   python osrm_stub.py [n_routes] [max_workers] [latency_seconds] [failure_rate]
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import polyline
+
+from distance_kernel import haversine_miles
+from routing_client import OSRMClient
+
+# Santa Clara County bounding box, used for the random benchmark OD pairs
+SANTA_CLARA_BBOX = (-122.20, 36.89, -121.20, 37.49)
+
+
+def _make_handler(latency, failure_rate, n_vertices):
+    class OSRMStubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # urlsplit, as urlparse moves everything after the ';' between the two coordinates to .params
+            path = urlsplit(self.path).path
+            if not path.startswith("/route/v1/"):
+                return self._send(400, {"code": "InvalidUrl", "message": "Only the route service is stubbed"})
+            if latency:
+                time.sleep(latency)
+            if failure_rate and random.random() < failure_rate:
+                return self._send(503, {"code": "ServiceUnavailable"})
+
+            try:
+                coords = path.rsplit("/", 1)[1].split(";")
+                (lon1, lat1), (lon2, lat2) = [tuple(float(v) for v in c.split(",")) for c in coords]
+            except ValueError:
+                return self._send(400, {"code": "InvalidQuery", "message": "Query string malformed"})
+
+            points = [
+                (lat1 + (lat2 - lat1) * i / (n_vertices - 1), lon1 + (lon2 - lon1) * i / (n_vertices - 1))
+                for i in range(n_vertices)
+            ]
+            meters = float(haversine_miles(lat1, lon1, lat2, lon2)) * 1609.344
+            self._send(200, {
+                "code": "Ok",
+                "routes": [{"geometry": polyline.encode(points), "distance": meters, "duration": meters / 15.0}],
+                "waypoints": [],
+            })
+
+        def _send(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return OSRMStubHandler
+
+
+def start_stub_server(port=0, latency=0.0, failure_rate=0.0, n_vertices=20):
+    """Start the stub in a background thread. Returns (server, base_url); call server.shutdown() to stop it."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), _make_handler(latency, failure_rate, n_vertices))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def random_od_pairs(n, bbox=SANTA_CLARA_BBOX, seed=0):
+    rng = random.Random(seed)
+    minx, miny, maxx, maxy = bbox
+    return [
+        ((rng.uniform(miny, maxy), rng.uniform(minx, maxx)), (rng.uniform(miny, maxy), rng.uniform(minx, maxx)))
+        for _ in range(n)
+    ]
+
+
+def benchmark(client, od_pairs, max_workers):
+    """Route every OD pair with max_workers threads, returns (routes per second, number of failed routes)."""
+    def route(pair):
+        try:
+            client.route_polyline(*pair)
+            return True
+        except Exception: # every error is a failed route, not only the routing errors of the client
+            return False
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        ok = list(executor.map(route, od_pairs))
+    elapsed = time.time() - start
+    return len(od_pairs) / elapsed if elapsed else float("inf"), ok.count(False)
+
+
+def main():
+    n_routes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.005
+    failure_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+
+    server, url = start_stub_server(latency=latency, failure_rate=failure_rate)
+    client = OSRMClient(url, pool_size=max_workers, backoff=0.05)
+    rate, failed = benchmark(client, random_od_pairs(n_routes), max_workers)
+    print(f"{n_routes} routes, {max_workers} workers: {rate:.1f} routes/s, {failed} failed")
+    client.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Road-class labels of route segments, from the TIGER primary/secondary roads layer (data/tl_2025_06_prisecroads).
+# Every segment midpoint of a batch is snapped to its nearest road line in one bulk STRtree query and labeled by the
+# MTFCC of that road: S1100 primary roads (interstates when RTTYP is 'I'), S1200 secondary roads. Midpoints farther
+# than SNAP_DISTANCE_DEG from any road in the layer are on local streets, which the layer does not contain.
+# The attribution then splits the miles of every route per (ZCTA, road class), so emission factors that depend on the
+# facility type can be applied later without routing again.
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
+
+from geometry_cache import read_layer
+from road_router import PRISECROADS_SHP
+from vmt_tensor import KEY_COLS, build_vmt_tensor
+
+ROAD_CLASSES = ['interstate', 'primary', 'secondary', 'local']
+LOCAL = ROAD_CLASSES.index('local')
+SNAP_DISTANCE_DEG = 0.0005 # ~50 m, larger than the offset between OSRM geometries and the TIGER lines of the same road
+
+
+def road_class_codes(roads) -> np.ndarray:
+    """Index in ROAD_CLASSES of every road of a TIGER roads layer (MTFCC and RTTYP columns)."""
+    mtfcc = roads['MTFCC'].to_numpy()
+    rttyp = roads['RTTYP'].to_numpy() if 'RTTYP' in roads else np.full(len(roads), None)
+    return np.select(
+        [(mtfcc == 'S1100') & (rttyp == 'I'), mtfcc == 'S1100', mtfcc == 'S1200'],
+        [ROAD_CLASSES.index('interstate'), ROAD_CLASSES.index('primary'), ROAD_CLASSES.index('secondary')],
+        default=LOCAL,
+    ).astype(np.int8)
+
+
+class RoadClassifier:
+    """
+    Labels points with the road class of the nearest road line.
+
+    Args:
+        geoms: road line geometries in EPSG:4326.
+        classes: index in ROAD_CLASSES of every road.
+        snap_distance: maximum point-to-road distance (degrees) to take the class of the road, LOCAL beyond.
+    """
+
+    n_classes = len(ROAD_CLASSES)
+
+    def __init__(self, geoms, classes, snap_distance=SNAP_DISTANCE_DEG):
+        self.geoms = np.asarray(geoms)
+        self.classes = np.asarray(classes, dtype=np.int8)
+        self.snap_distance = snap_distance
+        self.tree = shapely.STRtree(self.geoms)
+
+    @classmethod
+    def load(cls, roads_path=PRISECROADS_SHP, bbox=None, snap_distance=SNAP_DISTANCE_DEG):
+        """Classifier on the roads of the layer intersecting bbox (lon/lat), read through the geometry cache."""
+        roads = read_layer(roads_path, "prisecroads", bbox=bbox)
+        return cls(roads.geometry.values, road_class_codes(roads), snap_distance)
+
+    def classify(self, lat, lon) -> np.ndarray:
+        """Road class index of every point, in one bulk nearest-road query."""
+        labels = np.full(len(lat), LOCAL, dtype=np.int8)
+        point_idx, road_idx = self.tree.query_nearest(
+            shapely.points(lon, lat), max_distance=self.snap_distance, all_matches=False
+        )
+        labels[point_idx] = self.classes[road_idx]
+        return labels
+
+
+def collapse_classes(class_miles, n_zcta):
+    """Route x ZCTA miles, summed over the road classes of a route x (ZCTA, road class) matrix."""
+    n_classes = len(ROAD_CLASSES)
+    collapse = sparse.csr_matrix(
+        (np.ones(n_zcta * n_classes), (np.arange(n_zcta * n_classes), np.repeat(np.arange(n_zcta), n_classes))),
+        shape=(n_zcta * n_classes, n_zcta),
+    )
+    return (sparse.csr_matrix(class_miles) @ collapse).tocsr()
+
+
+def build_class_vmt_tensor(fanout_df: pd.DataFrame, class_miles, zcta_codes) -> pd.DataFrame:
+    """
+    VMT tensor of vmt_tensor.build_vmt_tensor with a road_class column.
+    class_miles: sparse (len(fanout_df) x n_zcta * len(ROAD_CLASSES)) matrix, column zcta * len(ROAD_CLASSES) + class.
+    """
+    vmt = build_vmt_tensor(fanout_df, class_miles, np.arange(class_miles.shape[1]))
+    column = vmt['receptor_zip'].to_numpy()
+    vmt['receptor_zip'] = np.asarray(zcta_codes)[column // len(ROAD_CLASSES)]
+    vmt.insert(len(KEY_COLS), 'road_class', np.asarray(ROAD_CLASSES)[column % len(ROAD_CLASSES)])
+    return vmt
+
+
+def receptor_class_table(vmt_by_class: pd.DataFrame) -> pd.DataFrame:
+    """Vehicle miles per receptor ZIP, one column per road class."""
+    table = vmt_by_class.pivot_table(index='receptor_zip', columns='road_class', values='miles', aggfunc='sum', fill_value=0.0)
+    table = table.reindex(columns=ROAD_CLASSES, fill_value=0.0)
+    table.columns = [f"{road_class}_miles" for road_class in ROAD_CLASSES]
+    return table.reset_index().rename(columns={'receptor_zip': 'zip'})
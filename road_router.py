@@ -0,0 +1,137 @@
+# Offline router on the TIGER primary and secondary roads (data/tl_2025_06_prisecroads).
+# Road lines are split into edges between consecutive vertices, vertices shared by several roads (same coordinates
+# to NODE_PRECISION decimals) become graph nodes, and the edges are stored as a CSR matrix of miles. The graph is
+# cached to disk, keyed by the shapefile hash and the bbox, so it is only built once. Routes come from
+# scipy.sparse.csgraph.dijkstra: one shortest-path tree per origin node serves every destination of that origin,
+# instead of one routing call per OD pair, so a full county runs on a compute node without any routing server.
+#
+# Block centroids join the network at their nearest node with a straight connector. The layer only holds primary
+# and secondary roads, so local streets are approximated by these connectors, and roads are treated as two-way.
+import os
+
+import numpy as np
+import pandas as pd
+import polyline
+import shapely
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from distance_kernel import haversine_miles
+from geometry_cache import read_layer, source_hash
+
+PRISECROADS_SHP = "data/tl_2025_06_prisecroads/tl_2025_06_prisecroads.shp"
+GRAPH_CACHE_DIR = "data/road_graph"
+NODE_PRECISION = 6 # decimals of the vertex coordinates merged into one node (~0.1 m)
+ORIGIN_BLOCK = 64  # shortest-path trees computed per dijkstra call, bounds the predecessor matrix memory
+
+
+class RoadGraph:
+    """
+    Undirected road graph.
+
+    Args:
+        graph: (n_nodes x n_nodes) sparse matrix of edge lengths in miles (upper triangle).
+        node_lat, node_lon: node coordinates.
+    """
+
+    def __init__(self, graph, node_lat, node_lon):
+        self.graph = sparse.csr_matrix(graph)
+        self.node_lat = np.asarray(node_lat, dtype=np.float64)
+        self.node_lon = np.asarray(node_lon, dtype=np.float64)
+        # Equirectangular projection around the network, good enough to find the nearest node at county scale
+        self._lon_scale = np.cos(np.radians(self.node_lat.mean())) if len(self.node_lat) else 1.0
+        self._tree = cKDTree(np.column_stack([self.node_lon * self._lon_scale, self.node_lat]))
+
+    @classmethod
+    def build(cls, roads_path=PRISECROADS_SHP, bbox=None):
+        """Build the graph from the road lines intersecting bbox (lon/lat), or the whole layer."""
+        roads = read_layer(roads_path, "prisecroads", bbox=bbox)
+        lines = shapely.get_parts(np.asarray(roads.geometry.values))
+        coords, line_idx = shapely.get_coordinates(lines, return_index=True)
+
+        nodes, node_of = np.unique(np.round(coords, NODE_PRECISION), axis=0, return_inverse=True)
+        node_of = node_of.ravel()
+        same_line = line_idx[1:] == line_idx[:-1]
+        a, b = node_of[:-1][same_line], node_of[1:][same_line]
+        lon1, lat1 = coords[:-1][same_line].T
+        lon2, lat2 = coords[1:][same_line].T
+        edges = pd.DataFrame({
+            'a': np.minimum(a, b),
+            'b': np.maximum(a, b),
+            'miles': haversine_miles(lat1, lon1, lat2, lon2),
+        })
+        # Parallel edges keep the shortest length, loops on a single node are dropped
+        edges = edges[edges['a'] != edges['b']].groupby(['a', 'b'], as_index=False)['miles'].min()
+        graph = sparse.coo_matrix(
+            (edges['miles'].to_numpy(), (edges['a'].to_numpy(), edges['b'].to_numpy())), shape=(len(nodes), len(nodes))
+        )
+        return cls(graph, nodes[:, 1], nodes[:, 0])
+
+    @classmethod
+    def load(cls, roads_path=PRISECROADS_SHP, bbox=None, cache_dir=GRAPH_CACHE_DIR):
+        """Cached build(): the graph is read from cache_dir when the shapefile and bbox did not change."""
+        bbox_key = "all" if bbox is None else "_".join(f"{float(v):.4f}" for v in bbox)
+        path = os.path.join(cache_dir, f"road_graph_{source_hash(roads_path)[:16]}_{bbox_key}.npz")
+        if os.path.exists(path):
+            cached = np.load(path)
+            n = len(cached['node_lat'])
+            graph = sparse.csr_matrix((cached['data'], cached['indices'], cached['indptr']), shape=(n, n))
+            return cls(graph, cached['node_lat'], cached['node_lon'])
+
+        road_graph = cls.build(roads_path, bbox)
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, data=road_graph.graph.data, indices=road_graph.graph.indices, indptr=road_graph.graph.indptr,
+                     node_lat=road_graph.node_lat, node_lon=road_graph.node_lon)
+        os.replace(path + ".tmp", path)
+        return road_graph
+
+    def nearest_node(self, lat, lon) -> np.ndarray:
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        return self._tree.query(np.column_stack([lon * self._lon_scale, lat]))[1]
+
+    @staticmethod
+    def _path(predecessors, origin, destination):
+        """Nodes from origin to destination in a shortest-path tree, None when destination is unreachable."""
+        path = [destination]
+        node = destination
+        while node != origin:
+            node = predecessors[node]
+            if node < 0:
+                return None
+            path.append(node)
+        return path[::-1]
+
+    def route_polylines(self, routes):
+        """
+        Route every row of routes (home_lat, home_lon, work_lat, work_lon, indexed by route key as in
+        od_compaction) and yield (route_idx, encoded polyline), or (route_idx, None) when there is no route.
+        Routes are processed grouped by origin node, ORIGIN_BLOCK shortest-path trees at a time.
+        """
+        coords = routes[['home_lat', 'home_lon', 'work_lat', 'work_lon']].to_numpy(dtype=np.float64)
+        valid = ~np.isnan(coords).any(axis=1)
+        for route_idx in routes.index[~valid]:
+            yield route_idx, None
+        keys, coords = routes.index[valid], coords[valid]
+
+        origin = self.nearest_node(coords[:, 0], coords[:, 1])
+        destination = self.nearest_node(coords[:, 2], coords[:, 3])
+        order = np.argsort(origin, kind='stable')
+        origin_nodes, starts = np.unique(origin[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+
+        for block_start in range(0, len(origin_nodes), ORIGIN_BLOCK):
+            block = slice(block_start, block_start + ORIGIN_BLOCK)
+            _, predecessors = dijkstra(self.graph, directed=False, indices=origin_nodes[block], return_predecessors=True)
+            for tree, origin_node, start, end in zip(predecessors, origin_nodes[block], starts[block], ends[block]):
+                for i in order[start:end]:
+                    path = self._path(tree, origin_node, destination[i])
+                    if path is None:
+                        yield keys[i], None
+                        continue
+                    points = [(coords[i, 0], coords[i, 1])]
+                    points += list(zip(self.node_lat[path], self.node_lon[path]))
+                    points.append((coords[i, 2], coords[i, 3]))
+                    yield keys[i], polyline.encode(points)
@@ -0,0 +1,175 @@
+# Persistent on-disk cache of routed commutes, shared by the OSRM and Google routing scripts.
+# Routes are keyed by the rounded (home_lat, home_lon, work_lat, work_lon) of the block centroids plus the
+# routing profile, and the encoded polyline returned by the router is stored as is. Re-running a scenario
+# (new emission factors, new fleet mix) on the cluster therefore costs zero routing calls.
+# Shards of a sharded run (see sharding.py) read the shared cache without locking it and store new routes in their own
+# file, which merge_shards.py merges back into the shared cache, so the cache does not depend on the shard count.
+import glob
+import os
+import sqlite3
+import threading
+
+# Default location of the cache database, next to the other data files
+DEFAULT_CACHE_PATH = "data/route_cache.sqlite"
+
+# Number of decimals kept when rounding coordinates for the cache key (5 decimals is roughly 1 m)
+DEFAULT_PRECISION = 5
+
+# Routing profiles used by the cluster scripts
+OSRM_PROFILE = "osrm-driving"
+GOOGLE_PROFILE = "google-drive-traffic"
+
+
+def shard_cache_path(path, shard, n_shards):
+    """Route cache file of one shard, next to the shared cache at path."""
+    return f"{os.path.splitext(path)[0]}_shard_{shard:04d}_of_{n_shards:04d}.sqlite"
+
+
+def shard_cache_paths(path):
+    """Route cache files of every shard of every shard count, next to the shared cache at path."""
+    return sorted(glob.glob(f"{os.path.splitext(path)[0]}_shard_*_of_*.sqlite"))
+
+
+class RouteCache:
+    """
+    SQLite backed route cache.
+
+    Args:
+        path: location of the SQLite file, created if it does not exist.
+        precision: number of decimals used to round the coordinates of the cache key.
+        version: version tag of the road data behind the router (e.g. the OSM extract date used to build
+            the OSRM graph). Entries stored under another version are ignored and can be removed with evict().
+        shared_path: optional cache looked up on a miss, read-only and without locking (it must not be written while
+            this cache is open), e.g. the shared cache of a sharded run. New routes are only stored at path.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, precision=DEFAULT_PRECISION, version="", shared_path=None):
+        self.path = path
+        self.precision = precision
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # One connection shared by the worker threads, access is serialized through self._lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS routes (
+                profile  TEXT    NOT NULL,
+                version  TEXT    NOT NULL,
+                o_lat    INTEGER NOT NULL,
+                o_lon    INTEGER NOT NULL,
+                d_lat    INTEGER NOT NULL,
+                d_lon    INTEGER NOT NULL,
+                geometry TEXT    NOT NULL,
+                PRIMARY KEY (profile, version, o_lat, o_lon, d_lat, d_lon)
+            )
+            """
+        )
+        self._conn.commit()
+        self._shared = None
+        if shared_path is not None and os.path.exists(shared_path):
+            self._shared = sqlite3.connect(f"file:{os.path.abspath(shared_path)}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+
+    def _key(self, profile, origin, destination):
+        # Coordinates are stored as scaled integers so that the rounding is exact and the key is cheap to compare
+        scale = 10 ** self.precision
+        return (
+            profile,
+            self.version,
+            int(round(origin[0] * scale)),
+            int(round(origin[1] * scale)),
+            int(round(destination[0] * scale)),
+            int(round(destination[1] * scale)),
+        )
+
+    def get(self, profile, origin, destination):
+        """Return the cached encoded polyline for origin/destination (lat, lon), or None on a miss."""
+        key = self._key(profile, origin, destination)
+        query = "SELECT geometry FROM routes WHERE profile=? AND version=? AND o_lat=? AND o_lon=? AND d_lat=? AND d_lon=?"
+        with self._lock:
+            row = self._conn.execute(query, key).fetchone()
+            if row is None and self._shared is not None:
+                row = self._shared.execute(query, key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, profile, origin, destination, encoded_polyline):
+        """Store the encoded polyline of a route, replacing any previous entry with the same key."""
+        key = self._key(profile, origin, destination)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                key + (encoded_polyline,),
+            )
+            self._conn.commit()
+
+    def get_or_fetch(self, profile, origin, destination, fetch):
+        """
+        Return the encoded polyline for the route, calling fetch(origin, destination) only on a cache miss.
+        fetch must return the encoded polyline string; its result is stored before being returned.
+        """
+        encoded = self.get(profile, origin, destination)
+        if encoded is None:
+            encoded = fetch(origin, destination)
+            self.put(profile, origin, destination, encoded)
+        return encoded
+
+    def evict(self, profile=None, keep_version=None):
+        """
+        Delete cached routes and return the number of rows removed.
+
+        profile: only remove routes of this profile (all profiles if None).
+        keep_version: keep routes stored under this version and remove every other version
+            (e.g. evict(OSRM_PROFILE, keep_version=cache.version) after rebuilding OSRM on a new extract).
+        """
+        query = "DELETE FROM routes WHERE 1=1"
+        params = []
+        if profile is not None:
+            query += " AND profile=?"
+            params.append(profile)
+        if keep_version is not None:
+            query += " AND version<>?"
+            params.append(keep_version)
+        with self._lock:
+            removed = self._conn.execute(query, params).rowcount
+            self._conn.commit()
+        return removed
+
+    def merge(self, path):
+        """Copy every route of the cache file at path into this cache, returns the number of routes copied."""
+        with self._lock:
+            self._conn.execute("ATTACH DATABASE ? AS other", (path,))
+            try:
+                copied = self._conn.execute("INSERT OR REPLACE INTO routes SELECT * FROM other.routes").rowcount
+                self._conn.commit()
+            finally:
+                self._conn.execute("DETACH DATABASE other")
+        return copied
+
+    def stats(self):
+        """Return hit/miss counters and number of stored routes."""
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'stored_routes': size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+            if self._shared is not None:
+                self._shared.close()
@@ -0,0 +1,155 @@
+# Checkpointing of attributed routes, so that a crashed or walltime-killed run can be resumed.
+# Every batch returned by the attribution pool is appended to the checkpoint folder as its own Parquet chunk
+# (route_idx, receptor ZIP, miles, plus the road class when the miles are split by road class, see road_class.py).
+# Both matrices of a batch go in one chunk, written to a temporary file and renamed, so a kill never leaves a partial
+# chunk behind and the ZIP and road-class miles always cover the same routes. With --resume the chunks are read back,
+# their routes are skipped and their miles are combined with the newly routed ones.
+# A manifest stores a fingerprint of the routes table and of the attribution settings (distance mode, ZCTA assignment,
+# hash of the ZCTA index file...), so a checkpoint is never resumed against another OD file or with miles computed
+# another way.
+import glob
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from od_compaction import COORD_COLS
+from road_class import ROAD_CLASSES, collapse_classes
+from route_cache import DEFAULT_PRECISION
+
+MANIFEST = "manifest.json"
+
+
+def routes_fingerprint(routes: pd.DataFrame, settings=None) -> str:
+    """
+    Fingerprint of the route keys and their rounded coordinates.
+    settings: optional JSON-serializable dict of everything else that changes the checkpointed miles.
+    """
+    hashes = pd.util.hash_pandas_object(routes[COORD_COLS].round(DEFAULT_PRECISION), index=True)
+    fingerprint = f"{len(routes)}-{int(hashes.to_numpy().sum(dtype=np.uint64)):016x}"
+    if settings:
+        fingerprint += "-" + hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+    return fingerprint
+
+
+class RouteCheckpoint:
+    """
+    Append-only Parquet checkpoint of the route x ZCTA miles, keyed by route_idx.
+
+    Args:
+        folder: checkpoint folder, created if needed.
+        zcta_codes: ZCTA code of every column of the miles matrices.
+        fingerprint: routes_fingerprint of the routes and attribution settings of this run.
+        resume: keep the chunks of a previous run with the same fingerprint, otherwise they are deleted.
+        road_classes: the miles are also split by road class (road_class.ROAD_CLASSES), the split matrices have
+            the column zcta * len(ROAD_CLASSES) + class.
+    """
+
+    def __init__(self, folder, zcta_codes, fingerprint, resume=False, road_classes=False):
+        self.folder = folder
+        self.zcta_codes = np.asarray(zcta_codes)
+        self.road_classes = road_classes
+        # A split checkpoint is never resumed by a run without split, and the other way round
+        if road_classes:
+            fingerprint = f"{fingerprint}-road-classes"
+        os.makedirs(folder, exist_ok=True)
+
+        manifest_path = os.path.join(folder, MANIFEST)
+        if resume and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest['fingerprint'] != fingerprint:
+                raise ValueError(f"Checkpoint in {folder} was written for other routes or attribution settings, run without --resume to start over")
+        else:
+            for path in self._chunk_paths():
+                os.remove(path)
+            with open(manifest_path, "w") as f:
+                json.dump({'fingerprint': fingerprint}, f)
+        self.n_chunks = len(self._chunk_paths())
+
+    def _chunk_paths(self):
+        return sorted(glob.glob(os.path.join(self.folder, "chunk_*.parquet")))
+
+    def write(self, keys, miles, class_miles=None):
+        """
+        Append one attributed batch (route keys, sparse route x ZCTA miles matrix), in a single chunk file.
+        With road_classes, class_miles (route x (ZCTA, road class) miles) is stored instead of miles, which is its
+        sum over the road classes.
+        """
+        if not len(keys):
+            return
+        if self.road_classes and class_miles is None:
+            raise ValueError(f"Checkpoint in {self.folder} stores miles split by road class, class_miles is required")
+        matrix = class_miles if self.road_classes else miles
+        coo = sparse.coo_matrix(matrix)
+        keys = np.asarray(keys)
+        zcta_col = coo.col // len(ROAD_CLASSES) if self.road_classes else coo.col
+        # Routes without any mile in a ZCTA are kept with an empty receptor ZIP, so they are not routed again
+        empty = keys[np.diff(sparse.csr_matrix(matrix).indptr) == 0]
+        no_value = np.full(len(empty), None, dtype=object)
+        chunk = pd.DataFrame({
+            'route_idx': np.concatenate([keys[coo.row], empty]),
+            'receptor_zip': np.concatenate([self.zcta_codes[zcta_col].astype(object), no_value]),
+            'miles': np.concatenate([coo.data, np.zeros(len(empty))]),
+        })
+        if self.road_classes:
+            chunk['road_class'] = np.concatenate([np.asarray(ROAD_CLASSES, dtype=object)[coo.col % len(ROAD_CLASSES)], no_value])
+        path = os.path.join(self.folder, f"chunk_{self.n_chunks:06d}.parquet")
+        chunk.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+        self.n_chunks += 1
+
+    def load(self):
+        """
+        Returns (route_keys, sparse route x ZCTA miles matrix, sparse route x (ZCTA, road class) miles matrix) of
+        every checkpointed route, the last one is None without road_classes.
+        """
+        n_zcta = len(self.zcta_codes)
+        n_classes = len(ROAD_CLASSES) if self.road_classes else 1
+        chunks = [pd.read_parquet(path) for path in self._chunk_paths()]
+        if chunks:
+            done = pd.concat(chunks, ignore_index=True)
+        else:
+            done = pd.DataFrame({'route_idx': [], 'receptor_zip': [], 'miles': [], 'road_class': []})
+        keys, rows = np.unique(done['route_idx'].to_numpy(), return_inverse=True)
+        hit = done['receptor_zip'].notna().to_numpy()
+        cols = pd.Index(self.zcta_codes).get_indexer(done['receptor_zip'][hit])
+        if (cols < 0).any():
+            raise ValueError(f"Checkpoint in {self.folder} has ZIPs missing from the ZCTA index, run without --resume to start over")
+        if self.road_classes:
+            cols = cols * n_classes + pd.Index(ROAD_CLASSES).get_indexer(done['road_class'][hit])
+        matrix = sparse.csr_matrix(
+            (done['miles'].to_numpy()[hit], (rows[hit], cols)), shape=(len(keys), n_zcta * n_classes)
+        )
+        if not self.road_classes:
+            return list(keys), matrix, None
+        return list(keys), collapse_classes(matrix, n_zcta), matrix
+
+
+class Progress:
+    """Prints the number of routes done, the throughput and the remaining time every `every` seconds."""
+
+    def __init__(self, total, done=0, every=60.0):
+        self.total = total
+        self.done = done
+        self.every = every
+        self.n = 0
+        self.start = self._last = time.time()
+
+    def update(self, n=1):
+        self.n += n
+        now = time.time()
+        if now - self._last >= self.every:
+            self._last = now
+            self.report()
+
+    def report(self):
+        elapsed = time.time() - self.start
+        rate = self.n / elapsed if elapsed else 0.0
+        remaining = self.total - self.done - self.n
+        eta = f"{remaining / rate / 60:.1f} min" if rate else "unknown"
+        print(f"Progress: {self.done + self.n}/{self.total} routes ({rate:.1f} routes/s, {remaining} left, ETA {eta})")
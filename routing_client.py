@@ -0,0 +1,72 @@
+# Routing client layer for the local OSRM server.
+# One pooled requests.Session is shared by all worker threads (keep-alive connections instead of a new TCP
+# connection per route), every request has a timeout, and connection resets / 5xx answers are retried with
+# exponential backoff so a busy server no longer turns into failed routes when more workers are used.
+# The OSRM table service only returns durations/distances, not geometries, so routes still go through /route.
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_OSRM_URL = "http://localhost:5000"
+
+
+class OSRMClient:
+    """
+    Client for the OSRM /route/v1/{profile} endpoint.
+
+    Args:
+        base_url: server address, e.g. http://localhost:5000.
+        profile: OSRM profile in the URL ('driving' for the car graph).
+        pool_size: maximum number of pooled connections, should be at least the number of worker threads.
+        timeout: (connect, read) timeout in seconds for each request.
+        max_retries: number of retries after a connection error, timeout, 429 or 5xx answer.
+        backoff: base delay in seconds, the n-th retry waits backoff * 2**n.
+    """
+
+    def __init__(self, base_url=DEFAULT_OSRM_URL, profile="driving", pool_size=8, timeout=(5, 60), max_retries=5, backoff=0.5):
+        self.base_url = base_url.rstrip("/")
+        self.profile = profile
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def route_polyline(self, origin, destination):
+        """
+        origin/destination: (lat, lon)
+        Returns the encoded polyline of the route, raises RuntimeError when OSRM finds no route or keeps failing.
+        """
+        url = f"{self.base_url}/route/v1/{self.profile}/{origin[1]},{origin[0]};{destination[1]},{destination[0]}"
+        params = {"overview": "full", "geometries": "polyline"}
+
+        last_err = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_err = e
+                continue
+            if response.status_code == 429 or response.status_code >= 500:
+                last_err = RuntimeError(f"OSRM server error: {response.status_code}")
+                continue
+
+            # Client-side errors (e.g. NoRoute, InvalidQuery) are not retried
+            try:
+                route_data = response.json()
+            except ValueError as e:
+                raise RuntimeError(f"OSRM returned an invalid response ({response.status_code}): {e}") from e
+            if route_data.get('code') != 'Ok' or not route_data.get('routes'):
+                raise RuntimeError(f"OSRM routing failed: {route_data.get('code')} {route_data.get('message', '')}".strip())
+            return route_data['routes'][0]['geometry']
+
+        raise RuntimeError(f"OSRM routing failed after {self.max_retries + 1} attempts: {last_err}")
+
+    def close(self):
+        self.session.close()
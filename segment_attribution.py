@@ -0,0 +1,188 @@
+# Batch attribution of route miles to ZIP code areas (ZCTAs).
+# Instead of building a GeoDataFrame and running a spatial join for every route, the decoded coordinates of
+# thousands of routes are packed into flat NumPy arrays (with offsets marking where each route starts),
+# segment lengths and midpoints are computed vectorially and every midpoint is assigned to a ZCTA in one
+# bulk STRtree query. The result is a sparse route x ZCTA matrix of miles.
+# In 'clip' assignment the segments are intersected with the ZCTA polygons instead: segments within one polygon keep
+# their full length and only the ones crossing a boundary are clipped, with shapely's vectorized intersection on the
+# candidate pairs of the STRtree, so a long segment near a boundary is split exactly between the two ZCTAs. A segment
+# lying on an edge shared by two ZCTAs is split between them, the pieces of a segment never add up to more than it.
+import numpy as np
+import shapely
+from scipy import sparse
+
+from distance_kernel import batch_route_miles
+
+
+def pack_routes(routes):
+    """
+    Pack a list of routes, each a list of (lat, lon) tuples as returned by polyline.decode, into flat arrays.
+    Returns (lat, lon, offsets) where the points of route i are lat[offsets[i]:offsets[i + 1]].
+    """
+    lengths = np.fromiter((len(r) for r in routes), dtype=np.int64, count=len(routes))
+    offsets = np.zeros(len(routes) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    coords = np.array([point for route in routes for point in route], dtype=np.float64).reshape(-1, 2)
+    return coords[:, 0], coords[:, 1], offsets
+
+
+def route_segments(lat, lon, offsets, mode='haversine', return_start=False):
+    """
+    Split packed routes into segments between consecutive points of the same route.
+    Returns (seg_route, seg_miles, mid_lat, mid_lon), one entry per segment, followed by the index of the first
+    point of every segment when return_start is True.
+    mode selects the distance kernel, 'haversine' or 'vincenty' (see distance_kernel).
+    """
+    start, seg_miles = batch_route_miles(lat, lon, offsets, mode=mode)
+    end = start + 1
+    seg_route = np.searchsorted(offsets, start, side='right') - 1
+    mid_lat = (lat[start] + lat[end]) / 2
+    mid_lon = (lon[start] + lon[end]) / 2
+    if return_start:
+        return seg_route, seg_miles, mid_lat, mid_lon, start
+    return seg_route, seg_miles, mid_lat, mid_lon
+
+
+class SegmentAttributor:
+    """
+    Assigns route segments to ZCTAs through a spatial index built once on the ZCTA polygons.
+
+    Args:
+        zcta: GeoDataFrame of ZCTA polygons in EPSG:4326.
+        code_col: column holding the ZCTA code.
+        predicate: 'within' (segment midpoint strictly inside the polygon) or 'intersects' (boundary hits kept).
+        distance_mode: 'haversine' or 'vincenty', accuracy mode of the segment lengths (see distance_kernel).
+        road_classifier: optional road_class.RoadClassifier, used by attribute_by_class.
+        assignment: 'midpoint' (full segment length to the ZCTA of its midpoint, by predicate) or 'clip' (segment
+            length split between the ZCTAs it crosses, predicate is not used).
+    """
+
+    def __init__(self, zcta, code_col='ZCTA5CE20', predicate='within', distance_mode='haversine', road_classifier=None,
+                 assignment='midpoint'):
+        self.codes = zcta[code_col].to_numpy()
+        self.tree = shapely.STRtree(np.asarray(zcta.geometry.values))
+        self.predicate = predicate
+        self.distance_mode = distance_mode
+        self.road_classifier = road_classifier
+        self.assignment = assignment
+
+    @classmethod
+    def from_index(cls, zcta_index, predicate='within', distance_mode='haversine', road_classifier=None, assignment='midpoint'):
+        """Build an attributor sharing the polygons and STRtree of a ZCTAIndex (see zcta_index)."""
+        attributor = cls.__new__(cls)
+        attributor.codes = zcta_index.codes
+        attributor.tree = zcta_index.tree
+        attributor.predicate = predicate
+        attributor.distance_mode = distance_mode
+        attributor.road_classifier = road_classifier
+        attributor.assignment = assignment
+        return attributor
+
+    def _segment_miles(self, lat, lon, offsets):
+        """
+        Miles of every (segment, ZCTA) pair of a batch of packed routes.
+        Returns (seg_route, mid_lat, mid_lon) per segment and (seg_idx, zcta_idx, miles) per pair.
+        """
+        if self.assignment == 'midpoint':
+            seg_route, seg_miles, mid_lat, mid_lon = route_segments(lat, lon, offsets, mode=self.distance_mode)
+            # One bulk query for every segment midpoint of the batch
+            seg_idx, zcta_idx = self.tree.query(shapely.points(mid_lon, mid_lat), predicate=self.predicate)
+            return seg_route, mid_lat, mid_lon, seg_idx, zcta_idx, seg_miles[seg_idx]
+        if self.assignment != 'clip':
+            raise ValueError(f"Unknown assignment {self.assignment!r}, expected 'midpoint' or 'clip'")
+
+        seg_route, seg_miles, mid_lat, mid_lon, start = route_segments(lat, lon, offsets, mode=self.distance_mode, return_start=True)
+        ends = np.stack([np.column_stack([lon[start], lat[start]]), np.column_stack([lon[start + 1], lat[start + 1]])], axis=1)
+        segments = shapely.linestrings(ends)
+
+        # Segments inside a single ZCTA keep their full length
+        inside_idx, inside_zcta = self.tree.query(segments, predicate='within')
+        crossing = np.setdiff1d(np.arange(len(segments)), inside_idx)
+
+        # The others are intersected with every polygon they touch, their miles are split by the clipped fraction
+        cross_idx, cross_zcta = self.tree.query(segments[crossing], predicate='intersects')
+        cross_idx = crossing[cross_idx]
+        pieces = shapely.intersection(segments[cross_idx], self.tree.geometries[cross_zcta])
+        seg_length = shapely.length(segments[cross_idx])
+        fraction = np.divide(shapely.length(pieces), seg_length, out=np.zeros(len(cross_idx)), where=seg_length > 0)
+        # A segment running along the edge shared by two ZCTAs is fully clipped by both, its fractions are scaled so
+        # they never sum to more than the segment
+        total = np.bincount(cross_idx, fraction, minlength=len(segments))
+        fraction /= np.maximum(total[cross_idx], 1.0)
+
+        seg_idx = np.concatenate([inside_idx, cross_idx])
+        zcta_idx = np.concatenate([inside_zcta, cross_zcta])
+        miles = np.concatenate([seg_miles[inside_idx], seg_miles[cross_idx] * fraction])
+        return seg_route, mid_lat, mid_lon, seg_idx, zcta_idx, miles
+
+    def attribute(self, lat, lon, offsets):
+        """
+        Return a sparse (n_routes x n_zcta) CSR matrix with the miles each route travels in each ZCTA.
+        Column j corresponds to self.codes[j]; miles outside every ZCTA are dropped.
+        """
+        n_routes = len(offsets) - 1
+        seg_route, _, _, seg_idx, zcta_idx, miles = self._segment_miles(lat, lon, offsets)
+
+        # Duplicate (route, ZCTA) entries are summed when converting to CSR
+        return sparse.coo_matrix(
+            (miles, (seg_route[seg_idx], zcta_idx)),
+            shape=(n_routes, len(self.codes)),
+        ).tocsr()
+
+    def attribute_by_class(self, lat, lon, offsets):
+        """
+        Same as attribute, split by road class: returns a sparse (n_routes x n_zcta * n_classes) CSR matrix where
+        column zcta * n_classes + c holds the miles on roads of class c (see road_class.ROAD_CLASSES).
+        """
+        n_routes = len(offsets) - 1
+        n_classes = self.road_classifier.n_classes
+        seg_route, mid_lat, mid_lon, seg_idx, zcta_idx, miles = self._segment_miles(lat, lon, offsets)
+
+        # Segments are labeled by the road nearest to their midpoint
+        seg_class = self.road_classifier.classify(mid_lat, mid_lon)[seg_idx]
+        return sparse.coo_matrix(
+            (miles, (seg_route[seg_idx], zcta_idx * n_classes + seg_class)),
+            shape=(n_routes, len(self.codes) * n_classes),
+        ).tocsr()
+
+
+class StreamingAttribution:
+    """
+    Collects routes as they arrive from the routing stage and attributes them every batch_size routes, so only
+    the sparse miles rows are kept in memory and not the decoded coordinates. Runs in the calling process, which is
+    enough for the two Google requests in flight of GOOGLEAPI_SantaClara_cluster.py; the OSRM script uses
+    attribution_pool.AttributionPool, its multi-process counterpart.
+
+    Args:
+        attributor: SegmentAttributor used for each batch.
+        batch_size: number of routes attributed per spatial index query.
+    """
+
+    def __init__(self, attributor, batch_size=5000):
+        self.attributor = attributor
+        self.batch_size = batch_size
+        self._keys = []
+        self._coords = []
+        self._done_keys = []
+        self._done_miles = []
+
+    def add(self, route_idx, route_coords):
+        self._keys.append(route_idx)
+        self._coords.append(route_coords)
+        if len(self._coords) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._coords:
+            return
+        lat, lon, offsets = pack_routes(self._coords)
+        self._done_miles.append(self.attributor.attribute(lat, lon, offsets))
+        self._done_keys.extend(self._keys)
+        self._keys, self._coords = [], []
+
+    def result(self):
+        """Attribute the remaining routes and return (route_keys, sparse route x ZCTA miles matrix)."""
+        self.flush()
+        if not self._done_miles:
+            return [], sparse.csr_matrix((0, len(self.attributor.codes)))
+        return self._done_keys, sparse.vstack(self._done_miles, format='csr')
@@ -0,0 +1,74 @@
+# Shard mode for spreading one run over several cluster nodes.
+# Unique routes are partitioned by a hash of their rounded centroid coordinates, so the partition only depends on
+# the route itself (not on the row order of the OD file) and every OD row of a route lands in the same shard.
+# Each shard writes its partial A/B/C/D outputs and VMT tensor to its own directory; merge_shards.py sums them.
+# Each shard stores its new routes in its own route cache file, since SQLite locking is not reliable on the shared
+# cluster filesystem, and only reads the shared cache. merge_shards.py merges the shard caches into the shared one.
+#
+# The shard is selected with `--shard i/N` (0 <= i < N) or, in a SLURM job array, from SLURM_ARRAY_TASK_ID, e.g.
+#   sbatch --array=0-15 ...   ->   python OSRM_SantaClara_cluster.py
+import os
+import re
+
+import pandas as pd
+
+from od_compaction import COORD_COLS
+from route_cache import DEFAULT_PRECISION
+
+SHARDS_DIR = "shards"
+COMPLETE_MARKER = "_COMPLETE" # written by a shard once all its outputs are saved
+_SHARD_DIR_RE = re.compile(r"^shard_(\d+)_of_(\d+)$")
+
+
+def parse_shard(argv, environ=os.environ):
+    """
+    Returns (shard, n_shards) from `--shard i/N` in argv, else from the SLURM array variables, else (0, 1).
+    """
+    for k, arg in enumerate(argv):
+        if arg == "--shard" and k + 1 < len(argv):
+            value = argv[k + 1]
+        elif arg.startswith("--shard="):
+            value = arg.split("=", 1)[1]
+        else:
+            continue
+        try:
+            shard, n_shards = (int(v) for v in value.split("/"))
+        except ValueError:
+            raise ValueError(f"--shard expects i/N, got {value!r}")
+        break
+    else:
+        if "SLURM_ARRAY_TASK_ID" not in environ:
+            return 0, 1
+        # SLURM_ARRAY_TASK_COUNT is not set by older SLURM versions, the array is then assumed to be min..max
+        task_min = int(environ.get("SLURM_ARRAY_TASK_MIN", 0))
+        shard = int(environ["SLURM_ARRAY_TASK_ID"]) - task_min
+        n_shards = int(environ.get("SLURM_ARRAY_TASK_COUNT", int(environ.get("SLURM_ARRAY_TASK_MAX", task_min)) - task_min + 1))
+
+    if n_shards < 1 or not 0 <= shard < n_shards:
+        raise ValueError(f"Invalid shard {shard}/{n_shards}")
+    return shard, n_shards
+
+
+def shard_of(routes: pd.DataFrame, n_shards: int, coord_cols=COORD_COLS, precision: int = DEFAULT_PRECISION):
+    """Shard number of every route, from a stable hash of its rounded coordinates."""
+    hashes = pd.util.hash_pandas_object(routes[list(coord_cols)].round(precision), index=False)
+    return (hashes.to_numpy() % n_shards).astype(int)
+
+
+def shard_dir(output_dir, shard, n_shards):
+    """Directory of the partial outputs of one shard."""
+    return os.path.join(output_dir, SHARDS_DIR, f"shard_{shard:04d}_of_{n_shards:04d}")
+
+
+def list_shard_dirs(output_dir):
+    """Returns (n_shards, {shard: directory}) of the shard directories found under output_dir."""
+    found, sizes = {}, set()
+    root = os.path.join(output_dir, SHARDS_DIR)
+    for name in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        match = _SHARD_DIR_RE.match(name)
+        if match:
+            found[int(match.group(1))] = os.path.join(root, name)
+            sizes.add(int(match.group(2)))
+    if len(sizes) > 1:
+        raise ValueError(f"Shard directories of different runs found in {root}: N in {sorted(sizes)}")
+    return (sizes.pop() if sizes else 0), found
@@ -0,0 +1,174 @@
+# VMT attribution tensor: vehicle miles per (origin block group, origin ZIP, destination ZIP, receptor ZIP).
+# The routing scripts persist it once, and emissions for any number of emission-factor tables (e.g. EV-adoption
+# scenarios from emissions_toymodel_SantaClara.py) are then obtained with a sparse matrix product, without routing
+# or touching any geometry again.
+#
+# With --check, the tables of the factor table used by the routing script are compared with the CSVs it wrote.
+#
+# Usage:
+#   python vmt_tensor.py emissions_outputs/vmt_attribution.parquet data/avg_emissions_per_geoid_SantaClara.parquet [more ...]
+#   python vmt_tensor.py emissions_outputs/vmt_attribution.parquet data/avg_emissions_per_geoid_SantaClara.parquet --check emissions_outputs
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from emission_factors import POLLUTANTS, FACTOR_COLS, BLOCK_GROUP_COL
+from interchange import read_table
+
+KEY_COLS = ['block_group', 'origin_zip', 'dest_zip', 'receptor_zip']
+
+# Output tables: name -> grouping columns (same A/B/C/D outputs as the routing scripts)
+OUTPUTS = {
+    'receptor_zip_emissions': ['receptor_zip'],
+    'origin_zip_emissions': ['origin_zip'],
+    'destination_zip_emissions': ['dest_zip'],
+    'zip_to_zip_emissions_matrix': ['origin_zip', 'receptor_zip'],
+}
+# Receptor totals keep the 'zip' column name of the routing scripts (emission_aggregator.receptor_table)
+OUTPUT_COLUMNS = {('receptor_zip',): ['zip']}
+CHECK_RTOL = 1e-6
+
+
+def build_vmt_tensor(fanout_df: pd.DataFrame, miles, zcta_codes) -> pd.DataFrame:
+    """
+    Build the long-format VMT tensor.
+
+    fanout_df: OD rows with block_group, h_zcta and w_zcta columns (see od_compaction).
+    miles: sparse (len(fanout_df) x n_zcta) matrix of vehicle miles of each OD row in each receptor ZCTA.
+    zcta_codes: ZCTA code of every column of miles.
+    """
+    coo = sparse.coo_matrix(miles)
+    vmt = pd.DataFrame({
+        'block_group': fanout_df['block_group'].to_numpy()[coo.row],
+        'origin_zip': fanout_df['h_zcta'].to_numpy()[coo.row],
+        'dest_zip': fanout_df['w_zcta'].to_numpy()[coo.row],
+        'receptor_zip': np.asarray(zcta_codes)[coo.col],
+        'miles': coo.data,
+    })
+    vmt = vmt.dropna(subset=['origin_zip', 'dest_zip'])
+    return vmt.groupby(KEY_COLS, as_index=False)['miles'].sum()
+
+
+def save_vmt_tensor(vmt: pd.DataFrame, path: str):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    vmt.to_parquet(path, index=False)
+
+
+def load_vmt_tensor(path: str) -> pd.DataFrame:
+    return pd.read_parquet(path)
+
+
+def factor_array(tables: dict):
+    """
+    Stack emission-factor tables into one array.
+
+    tables: scenario name -> DataFrame with 'Census Block Group Code' and the *_per_mile columns.
+    Returns (scenario_names, block_group_codes, factors) with factors of shape (n_scenarios, n_block_groups, n_pollutants).
+    Block groups missing from a table get zero factors in that scenario.
+    """
+    names = list(tables)
+    indexed = [
+        t.assign(**{BLOCK_GROUP_COL: t[BLOCK_GROUP_COL].astype(str).str.zfill(12)})
+         .drop_duplicates(subset=BLOCK_GROUP_COL)
+         .set_index(BLOCK_GROUP_COL)[FACTOR_COLS]
+        for t in tables.values()
+    ]
+    codes = sorted(set().union(*(t.index for t in indexed)))
+    factors = np.stack([t.reindex(codes).fillna(0.0).to_numpy(dtype=float) for t in indexed])
+    return names, np.asarray(codes), factors
+
+
+def vmt_by(vmt: pd.DataFrame, by, block_group_codes):
+    """
+    Sum the tensor into a sparse (n_groups x n_block_groups) miles matrix.
+    Returns (groups, matrix) where groups is a DataFrame with the values of the `by` columns of every row.
+    Tensor rows whose block group is not in block_group_codes are dropped.
+    """
+    bg_pos = pd.Index(block_group_codes).get_indexer(vmt['block_group'])
+    keep = bg_pos >= 0
+    keys = vmt.loc[keep, by]
+    # Groups are numbered in order of first appearance, the same order as drop_duplicates keeps them
+    group_id = keys.groupby(by, sort=False, dropna=False).ngroup().to_numpy()
+    groups = keys.drop_duplicates().reset_index(drop=True)
+    matrix = sparse.coo_matrix(
+        (vmt.loc[keep, 'miles'].to_numpy(), (group_id, bg_pos[keep])),
+        shape=(len(groups), len(block_group_codes)),
+    ).tocsr()
+    return groups, matrix
+
+
+def evaluate_scenarios(vmt: pd.DataFrame, by, names, block_group_codes, factors) -> dict:
+    """
+    Emissions grouped by the `by` columns for every scenario, in one sparse matrix product.
+    Returns scenario name -> DataFrame with the `by` columns (named as in the routing script outputs, see
+    OUTPUT_COLUMNS) and one column per pollutant, sorted by the `by` columns.
+    """
+    groups, matrix = vmt_by(vmt, by, block_group_codes)
+    order = groups.sort_values(list(by)).index.to_numpy()
+    groups = groups.loc[order].reset_index(drop=True)
+    groups.columns = OUTPUT_COLUMNS.get(tuple(by), list(by))
+    n_scenarios, n_bg, n_pollutants = factors.shape
+    # (n_bg x n_scenarios * n_pollutants) so that all scenarios come out of a single product
+    stacked = factors.transpose(1, 0, 2).reshape(n_bg, n_scenarios * n_pollutants)
+    emissions = np.asarray(matrix @ stacked).reshape(len(groups), n_scenarios, n_pollutants)[order]
+    return {
+        name: pd.concat([groups, pd.DataFrame(emissions[:, s, :], columns=POLLUTANTS)], axis=1)
+        for s, name in enumerate(names)
+    }
+
+
+def compare_table(table: pd.DataFrame, reference: pd.DataFrame, keys) -> float:
+    """Largest relative difference of the pollutant columns of two emission tables, matched on the key columns."""
+    keys = list(keys)
+    table = table.assign(**{k: table[k].astype(str) for k in keys})
+    reference = reference.assign(**{k: reference[k].astype(str) for k in keys})
+    merged = table.merge(reference, on=keys, how='outer', suffixes=('', '_reference')).fillna(0.0)
+    values = merged[POLLUTANTS].to_numpy(dtype=float)
+    expected = merged[[f"{p}_reference" for p in POLLUTANTS]].to_numpy(dtype=float)
+    return float(np.max(np.abs(values - expected) / np.maximum(np.abs(expected), 1e-12), initial=0.0))
+
+
+def main():
+    args = sys.argv[1:]
+    check_dir = None
+    if "--check" in args:
+        i = args.index("--check")
+        check_dir = args[i + 1]
+        args = args[:i] + args[i + 2:]
+    if len(args) < 2:
+        print("usage: python vmt_tensor.py <vmt_attribution.parquet> <emission_factors.parquet|csv> [...] [--check <routing output dir>]")
+        sys.exit(1)
+    vmt = load_vmt_tensor(args[0])
+    tables = {
+        os.path.splitext(os.path.basename(path))[0]: read_table(path)
+        for path in args[1:]
+    }
+    names, codes, factors = factor_array(tables)
+
+    if check_dir is not None:
+        # The routing script applies the first factor table, its outputs must come out the same from the tensor
+        failed = False
+        for output, by in OUTPUTS.items():
+            table = evaluate_scenarios(vmt, by, names[:1], codes, factors[:1])[names[0]]
+            reference = pd.read_csv(os.path.join(check_dir, f"{output}.csv"), dtype=str)
+            diff = compare_table(table, reference, table.columns[:len(by)])
+            failed |= diff > CHECK_RTOL
+            print(f"[{'!' if diff > CHECK_RTOL else '✓'}] {output}: largest relative difference {diff:.2e}")
+        sys.exit(1 if failed else 0)
+
+    output_dir = "emissions_outputs"
+    for output, by in OUTPUTS.items():
+        for name, df in evaluate_scenarios(vmt, by, names, codes, factors).items():
+            path = os.path.join(output_dir, name, f"{output}.csv")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            df.to_csv(path, index=False)
+            print(f"[✓] {name}: {output} saved to {path} ({len(df)} rows)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Builds a county ZCTA index once and serializes it, so the routing scripts no longer read the national
+# ZCTA shapefile (~33k polygons) at startup nor scan every US ZIP polygon for each origin/destination lookup.
+# The ZCTAs intersecting the study bbox (county bounds plus a buffer, since routes may leave the county) are
+# selected with the county logic of Census_ZIPcode_filtering.py and saved as GeoParquet. On load an STRtree is
+# built over the few hundred remaining polygons (milliseconds), making point-in-ZCTA lookups O(log n).
+import numpy as np
+import geopandas as gpd
+import shapely
+
+from Census_ZIPcode_filtering import COUNTIES_SHP, ZCTA_SHP, load_sc_polygon, load_zctas
+
+# ======= EDIT THESE =======
+OUTPUT_INDEX = "data/zcta_index_06085.parquet" # GeoParquet file written by this script and read by the routing scripts
+BBOX_BUFFER_DEG = 0.1                          # buffer around the county bounds, in degrees (~10 km)
+# ==========================
+
+
+def study_bbox(county: gpd.GeoDataFrame, buffer_deg: float = BBOX_BUFFER_DEG):
+    """County bounds plus buffer_deg, as (minx, miny, maxx, maxy)."""
+    minx, miny, maxx, maxy = county.total_bounds
+    return (minx - buffer_deg, miny - buffer_deg, maxx + buffer_deg, maxy + buffer_deg)
+
+
+def select_study_zctas(zctas: gpd.GeoDataFrame, county: gpd.GeoDataFrame, buffer_deg: float = BBOX_BUFFER_DEG) -> gpd.GeoDataFrame:
+    """ZCTAs (ZCTA5, geometry) intersecting the county bbox plus buffer_deg, sorted by code."""
+    minx, miny, maxx, maxy = study_bbox(county, buffer_deg)
+    study = zctas.cx[minx:maxx, miny:maxy]
+    return study[["ZCTA5", "geometry"]].sort_values("ZCTA5").reset_index(drop=True)
+
+
+def build_zcta_index(counties_path: str, zcta_path: str, out_path: str, buffer_deg: float = BBOX_BUFFER_DEG) -> gpd.GeoDataFrame:
+    """Select the ZCTAs intersecting the buffered county bbox and save them (ZCTA5, geometry) as GeoParquet."""
+    county = load_sc_polygon(counties_path)
+    study = select_study_zctas(load_zctas(zcta_path, bbox=study_bbox(county, buffer_deg)), county, buffer_deg)
+    study.to_parquet(out_path, index=False)
+    return study
+
+
+class ZCTAIndex:
+    """
+    County ZCTA polygons with a prebuilt STRtree.
+
+    Args:
+        gdf: GeoDataFrame with a ZCTA5 column and polygon geometries in EPSG:4326.
+    """
+
+    def __init__(self, gdf: gpd.GeoDataFrame):
+        self.gdf = gdf.reset_index(drop=True)
+        self.codes = self.gdf["ZCTA5"].to_numpy()
+        self.tree = shapely.STRtree(np.asarray(self.gdf.geometry.values))
+
+    def lookup(self, lat, lon) -> np.ndarray:
+        """
+        Return the ZCTA code containing each (lat, lon) point, None where no ZCTA contains the point.
+        When polygons overlap, the first ZCTA in index order is kept.
+        """
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        out = np.full(len(lat), None, dtype=object)
+
+        point_idx, zcta_idx = self.tree.query(shapely.points(lon, lat), predicate="within")
+        if len(point_idx):
+            # hits are sorted by point then ZCTA, so the first hit of each point is its smallest ZCTA index
+            order = np.lexsort((zcta_idx, point_idx))
+            point_idx, zcta_idx = point_idx[order], zcta_idx[order]
+            first = np.unique(point_idx, return_index=True)[1]
+            out[point_idx[first]] = self.codes[zcta_idx[first]]
+        return out
+
+
+def load_zcta_index(index_path: str = OUTPUT_INDEX) -> ZCTAIndex:
+    return ZCTAIndex(gpd.read_parquet(index_path))
+
+
+def main():
+    study = build_zcta_index(COUNTIES_SHP, ZCTA_SHP, OUTPUT_INDEX)
+    print(f"Wrote {len(study)} ZCTAs to {OUTPUT_INDEX}")
+
+
+if __name__ == "__main__":
+    main()